@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+""" Headless benchmark runner for the canossa emulation core
+
+usage: python bench/run.py [options] [workload ...]
+
+Each workload runs in its own interpreter so that the peak RSS reported
+for it is not polluted by the others.
+"""
+
+import os
+import sys
+import time
+import json
+import platform
+import subprocess
+import optparse
+
+_BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_BENCHDIR))
+
+import workloads
+
+_NFRAMES = 3
+
+_HANDLERS = ['handle_char', 'handle_chars', 'handle_csi', 'handle_esc',
+             'handle_control_string', 'handle_draw']
+
+if sys.platform == 'win32':
+    _timer = time.clock
+else:
+    _timer = time.time
+
+
+def _peak_rss_kb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 1024  # bytes on darwin, kilobytes elsewhere
+    return rss
+
+
+class _Sink():
+    """ stands in for the tty side of a ParseContext """
+
+    def __init__(self):
+        self.size = 0
+
+    def puts(self, data):
+        self.size += len(data)
+
+
+class _Session():
+    """ the subset of tff.Session an InnerFrame touches """
+
+    def add_subtty(self, term, lang, command, row, col,
+                   termenc, inputhandler, outputhandler):
+        return object()
+
+    def process_is_active(self, tty):
+        return False
+
+
+class _Listener():
+    """ the subset of IInnerFrameListener an InnerFrame touches """
+
+    def initialize_mouse(self, window):
+        pass
+
+    def uninitialize_mouse(self, window):
+        pass
+
+
+def _generate_parser(canossa):
+    """ same wiring as screen._generate_mock_parser, keeping the handler """
+    import StringIO
+    from canossa.stub import tff
+
+    context = tff.ParseContext(output=StringIO.StringIO(),
+                               handler=canossa,
+                               buffering=False)
+    parser = tff.DefaultParser()
+    parser.init(context)
+    return parser
+
+
+class _Profile():
+
+    def __init__(self):
+        self.calls = {}
+        self.seconds = {}
+
+    def wrap(self, obj, name, key=None):
+        f = getattr(obj, name, None)
+        if f is None:
+            return
+        key = key or name
+        calls = self.calls
+        seconds = self.seconds
+        calls.setdefault(key, 0)
+        seconds.setdefault(key, 0.0)
+
+        def wrapper(*args):
+            start = _timer()
+            try:
+                return f(*args)
+            finally:
+                seconds[key] += _timer() - start
+                calls[key] += 1
+        setattr(obj, name, wrapper)
+
+    def getresult(self):
+        result = {}
+        for key, n in self.calls.items():
+            if n:
+                result[key] = {'calls': n, 'seconds': self.seconds[key]}
+        return result
+
+
+class _Target():
+    """ a fresh emulator instance the workload is fed into """
+
+    def __init__(self, kind, row, col, draw, profile=None):
+        import termprop
+        from canossa.screen import Screen
+        from canossa.output import Canossa
+
+        tp = termprop.MockTermprop()
+        self.sink = _Sink()
+        self._draw = draw
+        screen = Screen(row, col, 0, 0, 'UTF-8', tp)
+        self.screen = screen
+        if kind == 'screen':
+            canossa = Canossa(screen=screen, resized=False)
+            self._parsers = [_generate_parser(canossa)]
+            canossas = [canossa]
+            drawname = 'drawall'
+        else:
+            from canossa.iframe import InnerFrame
+            session = _Session()
+            listener = _Listener()
+            canossas = []
+            self._parsers = []
+            for i in xrange(_NFRAMES):
+                frame = InnerFrame(session, listener, screen,
+                                   2 + i * (row / 6), 2 + i * (col / 6),
+                                   row / 2, col / 2, 'bench', 'UTF-8', tp)
+                canossa = frame._canossa
+                canossa._resized = False  # no tty to ask for the position
+                canossas.append(canossa)
+                self._parsers.append(_generate_parser(canossa))
+            drawname = 'drawwindows'
+        if profile:
+            for canossa in canossas:
+                for name in _HANDLERS:
+                    profile.wrap(canossa, name)
+            profile.wrap(screen, drawname)
+        self._drawfunc = getattr(screen, drawname)
+
+    def feed(self, chunks):
+        parsers = self._parsers
+        draw = self._draw
+        drawfunc = self._drawfunc
+        sink = self.sink
+        for n, chunk in chunks:
+            parsers[n].parse(chunk)
+            if draw:
+                drawfunc(sink)
+
+
+def _load(name, options):
+    """ returns the target kind and one byte stream per parser """
+    if name.startswith('file:'):
+        f = open(name[5:], 'rb')
+        try:
+            return 'screen', [f.read()]
+        finally:
+            f.close()
+    for key, generator, kind in workloads.WORKLOADS:
+        if key == name:
+            if kind == 'screen':
+                n = 1
+            else:
+                n = _NFRAMES
+            return kind, [workloads.generate(name, options.rows, options.cols,
+                                             options.size / n, options.seed + i)
+                          for i in xrange(n)]
+    raise KeyError(name)
+
+
+def _split(streams, size):
+    """ interleaves the streams chunk by chunk, tagged with their index """
+    chunks = []
+    for n, data in enumerate(streams):
+        for i in xrange(0, len(data), size):
+            chunks.append((i, n, data[i:i + size]))
+    chunks.sort()
+    return [(n, chunk) for i, n, chunk in chunks]
+
+
+def run_child(name, options):
+    kind, streams = _load(name, options)
+    chunks = _split(streams, options.chunk)
+    draw = not options.nodraw
+
+    best = None
+    for i in xrange(options.repeat):
+        target = _Target(kind, options.rows, options.cols, draw)
+        start = _timer()
+        target.feed(chunks)
+        elapsed = _timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+            output = target.sink.size
+
+    # a separate pass, the wrappers cost more than most handlers
+    profile = _Profile()
+    target = _Target(kind, options.rows, options.cols, draw, profile)
+    target.feed(chunks)
+
+    nbytes = sum(len(data) for data in streams)
+    nseqs = sum(data.count('\x1b') for data in streams)
+    best = max(best, 1e-9)
+    return {'bytes': nbytes,
+            'sequences': nseqs,
+            'seconds': best,
+            'bytes_per_sec': nbytes / best,
+            'sequences_per_sec': nseqs / best,
+            'output_bytes': output,
+            'peak_rss_kb': _peak_rss_kb(),
+            'handlers': profile.getresult()}
+
+
+def _spawn(name, options, argv):
+    args = [sys.executable, os.path.abspath(__file__), '--child', name] + argv
+    env = dict(os.environ)
+    env.setdefault('LANG', 'en_US.UTF-8')
+    process = subprocess.Popen(args, stdout=subprocess.PIPE, env=env)
+    stdout, stderr = process.communicate()
+    if process.returncode != 0:
+        raise RuntimeError('workload %s failed (exit status %d)'
+                           % (name, process.returncode))
+    return json.loads(stdout)
+
+
+def _report(name, result, base=None):
+    line = ('%-24s %10.0f B/s %10.0f seq/s %8s KB'
+            % (name, result['bytes_per_sec'], result['sequences_per_sec'],
+               result['peak_rss_kb']))
+    if base and name in base:
+        line += '  x%.2f' % (result['bytes_per_sec'] / base[name]['bytes_per_sec'])
+    print line
+    handlers = result['handlers']
+    for key in sorted(handlers, key=lambda k: -handlers[k]['seconds']):
+        value = handlers[key]
+        print '    %-22s %9d calls %9.4f s' % (key, value['calls'], value['seconds'])
+
+
+def main():
+    parser = optparse.OptionParser(usage='%prog [options] [workload ...]')
+    parser.add_option('--rows', type='int', default=24)
+    parser.add_option('--cols', type='int', default=80)
+    parser.add_option('--size', type='int', default=1 << 20,
+                      help='bytes generated per workload')
+    parser.add_option('--chunk', type='int', default=4096,
+                      help='bytes per parse() call')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='timed runs per workload, the best one is kept')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--no-draw', dest='nodraw', action='store_true',
+                      default=False, help='do not render after each chunk')
+    parser.add_option('--input', action='append', default=[],
+                      help='replay a recorded typescript as a workload')
+    parser.add_option('--record', metavar='DIR',
+                      help='write the generated workloads into DIR and exit')
+    parser.add_option('--output', '-o', metavar='FILE',
+                      help='save the results as JSON')
+    parser.add_option('--compare', metavar='FILE',
+                      help='show the ratios against a saved JSON result')
+    parser.add_option('--child', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args()
+
+    if options.child:
+        sys.stdout.write(json.dumps(run_child(options.child, options)))
+        return
+
+    known = [key for key, generator, kind in workloads.WORKLOADS]
+    for name in args:
+        if name not in known:
+            parser.error('unknown workload: %s (choose from %s)'
+                         % (name, ', '.join(known)))
+    if args or options.input:
+        names = args
+    else:
+        names = known
+
+    if options.record:
+        for name in names:
+            kind, streams = _load(name, options)
+            for i, data in enumerate(streams):
+                if len(streams) > 1:
+                    filename = '%s.%d.typescript' % (name, i)
+                else:
+                    filename = '%s.typescript' % name
+                f = open(os.path.join(options.record, filename), 'wb')
+                try:
+                    f.write(data)
+                finally:
+                    f.close()
+        return
+
+    names += ['file:' + os.path.abspath(path) for path in options.input]
+
+    argv = ['--rows', str(options.rows), '--cols', str(options.cols),
+            '--size', str(options.size), '--chunk', str(options.chunk),
+            '--repeat', str(options.repeat), '--seed', str(options.seed)]
+    if options.nodraw:
+        argv.append('--no-draw')
+
+    base = None
+    if options.compare:
+        f = open(options.compare)
+        try:
+            base = json.load(f)['results']
+        finally:
+            f.close()
+
+    results = {}
+    for name in names:
+        result = _spawn(name, options, argv)
+        results[name] = result
+        _report(name, result, base)
+
+    if options.output:
+        document = {'python': sys.version.split()[0],
+                    'implementation': platform.python_implementation(),
+                    'platform': platform.platform(),
+                    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                    'options': {'rows': options.rows,
+                                'cols': options.cols,
+                                'size': options.size,
+                                'chunk': options.chunk,
+                                'repeat': options.repeat,
+                                'seed': options.seed,
+                                'draw': not options.nodraw},
+                    'results': results}
+        f = open(options.output, 'w')
+        try:
+            json.dump(document, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+""" Deterministic terminal output workloads for the benchmark suite """
+
+import random
+
+_WORDS = ['canossa', 'screen', 'terminal', 'emulator', 'sequence', 'cursor',
+          'attribute', 'line', 'cell', 'region', 'window', 'frame', 'buffer',
+          'scroll', 'parser', 'handler', 'context', 'output', 'input', 'tty']
+
+_KANA = [unichr(c) for c in xrange(0x3042, 0x3094)]
+_KANJI = [unichr(c) for c in xrange(0x4e00, 0x4e00 + 512)]
+_LATIN = u'aeiounyc'
+_COMBINING = [unichr(c) for c in (0x0300, 0x0301, 0x0302, 0x0303, 0x0308, 0x0327)]
+
+
+def _sentence(rng, width):
+    words = []
+    length = 0
+    while True:
+        word = rng.choice(_WORDS)
+        if length + len(word) + 1 > width:
+            break
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)
+
+
+def ascii_flood(rng, row, col, size):
+    """ plain printable text separated by CR LF, like cat(1) on a log """
+    result = []
+    total = 0
+    while total < size:
+        s = _sentence(rng, rng.randint(1, col * 2)) + '\r\n'
+        result.append(s)
+        total += len(s)
+    return ''.join(result)
+
+
+def sgr_colored(rng, row, col, size):
+    """ every word wrapped in 16/256 color SGR, like ls --color or a compiler """
+    result = []
+    total = 0
+    while total < size:
+        for i in xrange(rng.randint(1, 12)):
+            kind = rng.randint(0, 3)
+            if kind == 0:
+                sgr = '\x1b[%dm' % rng.randint(31, 37)
+            elif kind == 1:
+                sgr = '\x1b[1;%d;%dm' % (rng.randint(30, 37), rng.randint(40, 47))
+            elif kind == 2:
+                sgr = '\x1b[38;5;%dm' % rng.randint(0, 255)
+            else:
+                sgr = '\x1b[4;7m'
+            s = sgr + rng.choice(_WORDS) + '\x1b[m '
+            result.append(s)
+            total += len(s)
+        result.append('\r\n')
+        total += 2
+    return ''.join(result)
+
+
+def truecolor(rng, row, col, size):
+    """ 24-bit colors, italic and styled underlines, like a modern highlighter """
+    result = []
+    total = 0
+    while total < size:
+        for i in xrange(rng.randint(1, 12)):
+            kind = rng.randint(0, 3)
+            rgb = (rng.randint(0, 255), rng.randint(0, 255), rng.randint(0, 255))
+            if kind == 0:
+                sgr = '\x1b[38;2;%d;%d;%dm' % rgb
+            elif kind == 1:
+                sgr = '\x1b[3;48:2::%d:%d:%dm' % rgb
+            elif kind == 2:
+                sgr = '\x1b[4:3;58;2;%d;%d;%dm' % rgb
+            else:
+                sgr = '\x1b[2;9m'
+            s = sgr + rng.choice(_WORDS) + '\x1b[m '
+            result.append(s)
+            total += len(s)
+        result.append('\r\n')
+        total += 2
+    return ''.join(result)
+
+
+def cjk_combining(rng, row, col, size):
+    """ UTF-8 Japanese text mixed with latin letters carrying combining marks """
+    result = []
+    total = 0
+    while total < size:
+        chars = []
+        width = 0
+        limit = rng.randint(1, col - 2)
+        while width < limit:
+            kind = rng.randint(0, 2)
+            if kind == 0:
+                chars.append(rng.choice(_KANA))
+                width += 2
+            elif kind == 1:
+                chars.append(rng.choice(_KANJI))
+                width += 2
+            else:
+                chars.append(rng.choice(_LATIN))
+                chars.append(rng.choice(_COMBINING))
+                width += 1
+        s = (u''.join(chars) + u'\r\n').encode('utf-8')
+        result.append(s)
+        total += len(s)
+    return ''.join(result)
+
+
+def scroll_region(rng, row, col, size):
+    """ DECSTBM regions with IND/RI churn inside, like a pager or tmux pane """
+    result = []
+    total = 0
+    while total < size:
+        top = rng.randint(1, row / 2)
+        bottom = rng.randint(top + 2, row)
+        chunk = ['\x1b[%d;%dr' % (top, bottom)]
+        for i in xrange(rng.randint(4, 32)):
+            if rng.randint(0, 3):
+                chunk.append('\x1b[%dH%s\x1bD' % (bottom, _sentence(rng, col - 1)))
+            else:
+                chunk.append('\x1b[%dH%s\x1bM' % (top, _sentence(rng, col - 1)))
+        chunk.append('\x1b[r')
+        s = ''.join(chunk)
+        result.append(s)
+        total += len(s)
+    return ''.join(result)
+
+
+def vim_redraw(rng, row, col, size):
+    """ full-screen repaints with a status line, plus cursor-addressed edits """
+    result = []
+    total = 0
+    while total < size:
+        frame = ['\x1b[?25l\x1b[H\x1b[2J']
+        for y in xrange(1, row - 1):
+            if rng.randint(0, 4):
+                frame.append('\x1b[%dH\x1b[33m%3d \x1b[m%s'
+                             % (y, y, _sentence(rng, col - 5)))
+            else:
+                frame.append('\x1b[%dH\x1b[94m~\x1b[m' % y)
+        frame.append('\x1b[%dH\x1b[7m%s\x1b[m' % (row - 1, ' "file.txt" '.ljust(col)))
+        for i in xrange(rng.randint(8, 64)):
+            y = rng.randint(1, row - 2)
+            frame.append('\x1b[%d;5H\x1b[K%s' % (y, _sentence(rng, col - 5)))
+        frame.append('\x1b[%dH\x1b[?25h' % row)
+        s = ''.join(frame)
+        result.append(s)
+        total += len(s)
+    return ''.join(result)
+
+
+# name: (generator, target)
+# target 'screen' feeds a single Screen, 'frames' feeds inner frames
+# composited on an outer Screen.
+WORKLOADS = [
+    ('ascii', ascii_flood, 'screen'),
+    ('sgr', sgr_colored, 'screen'),
+    ('truecolor', truecolor, 'screen'),
+    ('cjk', cjk_combining, 'screen'),
+    ('scroll', scroll_region, 'screen'),
+    ('vim', vim_redraw, 'screen'),
+    ('frames', sgr_colored, 'frames'),
+]
+
+
+def generate(name, row, col, size, seed=0):
+    """
+    >>> data = generate('ascii', 24, 80, 1000)
+    >>> len(data) >= 1000
+    True
+    >>> data == generate('ascii', 24, 80, 1000)
+    True
+    >>> data = generate('cjk', 24, 80, 64)
+    >>> len(data.decode('utf-8')) < len(data)
+    True
+    """
+    for key, generator, target in WORKLOADS:
+        if key == name:
+            return generator(random.Random(seed), row, col, size)
+    raise KeyError(name)
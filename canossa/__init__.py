@@ -37,6 +37,9 @@ from popup import *
 from mouse import *
 from iframe import *
 from screen import *
+from scrollback import *
+from search import *
+from driver import *
 from output import *
 
 ''' main '''
@@ -23,6 +23,7 @@
 # DEALINGS IN THE SOFTWARE.
 # ***** END LICENSE BLOCK *****
 
+import weakref
 
 _ATTR_BOLD = 1        # 00000000 00000000 00000000 00000010
 _ATTR_UNDERLINED = 4  # 00000000 00000000 00000000 00010000
@@ -32,9 +33,40 @@ _ATTR_INVISIBLE = 8   # 00000000 00000000 00000001 00000000
 _ATTR_FG = 9          # 00000000 00000011 11111110 00000000
 _ATTR_BG = 18         # 00000111 11111100 00000000 00000000
 _ATTR_NRC = 27        # 01111000 00000000 00000000 00000000
+_ATTR_EXT = 31        # 10000000 00000000 00000000 00000000
 
 _ATTR_DEFAULT = 0x100 << _ATTR_FG | 0x100 << _ATTR_BG
 
+# A word with the _ATTR_EXT bit set, that is a negative one, is ~index into
+# _EXT_TABLE, whose entries are (base, extras).  base is an ordinary word, whose fg/bg hold
+# the nearest 256 color of a truecolor one, and extras is
+#
+#   (flags, underline style, fg rgb, bg rgb, underline color)
+#
+# where a color of -1 is unset, and an underline color is either an index
+# or _EXT_RGB | rgb.  The same combination always gets the same word, so
+# cells still compare by integer equality.  Words fit in a signed 32 bit
+# integer, so array('l') holds them everywhere.
+#
+# The table is shared by the process and holds up to _EXT_MAX entries.
+# When it is full, a new one is built from the words still used by the live
+# screens (see _reclaim), which get their words renumbered.  If they still
+# use all of it, new combinations fall back to their 256 color form.  A
+# table is only ever appended to, and is never touched again once replaced,
+# so a frozen view keeps the one it was made with (see _current_table).
+_EXT_ITALIC = 0x1
+_EXT_FAINT = 0x2
+_EXT_STRIKE = 0x4
+_EXT_RGB = 0x1000000
+_EXT_NONE = (0, 0, -1, -1, -1)
+_EXT_MAX = 0x10000
+_EXT_RETRY = 0x1000  # interns to skip after a reclaim that freed little
+
+_EXT_TABLE = []
+_EXT_INDEX = {}
+_EXT_OWNERS = []     # weak references to the screens using the table
+_ext_backoff = 0
+
 _NRC_REVERSE_MAP = ['B', '0', 'A', '4',
                     'C', 'R', 'Q', 'K',
                     'Y', 'E', '6', 'Z',
@@ -45,6 +77,330 @@ for key, value in enumerate(_NRC_REVERSE_MAP):
     _NRC_MAP[ord(value)] = key
 
 
+def _intern(base, extras, reclaim=True):
+    """
+    Returns the word standing for base with extras.  When the table is
+    full and reclaiming frees nothing, new combinations lose their extras,
+    leaving the 256 color approximation in base.
+
+    >>> value = _intern(_ATTR_DEFAULT, (_EXT_ITALIC, 0, -1, -1, -1))
+    >>> value == _intern(_ATTR_DEFAULT, (_EXT_ITALIC, 0, -1, -1, -1))
+    True
+    >>> _split(value) == (_ATTR_DEFAULT, (_EXT_ITALIC, 0, -1, -1, -1))
+    True
+    >>> _intern(_ATTR_DEFAULT, _EXT_NONE) == _ATTR_DEFAULT
+    True
+    >>> base = _ATTR_DEFAULT & ~(0x1ff << _ATTR_FG) | 196 << _ATTR_FG
+    >>> _intern(base, (0, 0, 0xff0000, -1, -1), reclaim=False) == base
+    False
+    >>> _intern(base, (0, 0, 0xfe0000, -1, -1), reclaim=False) == base
+    False
+    >>> import attribute
+    >>> saved, attribute._EXT_MAX = attribute._EXT_MAX, len(_EXT_TABLE)
+    >>> _intern(base, (0, 0, 0xfd0000, -1, -1), reclaim=False) == base
+    True
+    >>> attribute._EXT_MAX = saved
+    """
+    if extras == _EXT_NONE:
+        return base
+    key = (base, extras)
+    index = _EXT_INDEX.get(key)
+    if index is None:
+        index = len(_EXT_TABLE)
+        if index >= _EXT_MAX:
+            if not reclaim or not _try_reclaim():
+                return base
+            index = len(_EXT_TABLE)
+        _EXT_TABLE.append(key)
+        _EXT_INDEX[key] = index
+    return ~index
+
+
+def _register_owner(owner):
+    """
+    Registers an object holding words, so that _reclaim keeps and
+    renumbers them.  It needs two methods: _collect_attrs(used), which adds
+    the words it holds to the set used, and _remap_attrs(mapping), which
+    replaces them with mapping.get(value, value).
+    """
+    _EXT_OWNERS.append(weakref.ref(owner, _EXT_OWNERS.remove))
+
+
+def _try_reclaim():
+    """ reclaims the table unless a recent reclaim freed too little """
+    global _ext_backoff
+    if _ext_backoff:
+        _ext_backoff -= 1
+        return False
+    _reclaim()
+    if len(_EXT_TABLE) > _EXT_MAX * 3 / 4:
+        _ext_backoff = _EXT_RETRY
+    return len(_EXT_TABLE) < _EXT_MAX
+
+
+def _reclaim():
+    """
+    Builds a new table from the words the registered owners still use,
+    renumbers them, and then replaces the table.  The old table is left
+    as it was, for the words held anywhere else.
+
+    >>> class Owner():
+    ...     def __init__(self, values):
+    ...         self.values = values
+    ...     def _collect_attrs(self, used):
+    ...         used.update(self.values)
+    ...     def _remap_attrs(self, mapping):
+    ...         self.values = [mapping.get(v, v) for v in self.values]
+    >>> first = _intern(_ATTR_DEFAULT, (_EXT_ITALIC, 2, -1, -1, -1))
+    >>> second = _intern(_ATTR_DEFAULT, (_EXT_ITALIC, 3, -1, -1, -1))
+    >>> owner = Owner([_ATTR_DEFAULT, second])
+    >>> _register_owner(owner)
+    >>> table = _current_table()
+    >>> _reclaim()
+    >>> import attribute
+    >>> (_ATTR_DEFAULT, (_EXT_ITALIC, 2, -1, -1, -1)) in attribute._EXT_INDEX
+    False
+    >>> [_split(value) for value in owner.values] == [
+    ...     (_ATTR_DEFAULT, _EXT_NONE),
+    ...     (_ATTR_DEFAULT, (_EXT_ITALIC, 3, -1, -1, -1))]
+    True
+    >>> _split(first, table) == (_ATTR_DEFAULT, (_EXT_ITALIC, 2, -1, -1, -1))
+    True
+    """
+    global _EXT_TABLE, _EXT_INDEX
+    owners = [ref() for ref in _EXT_OWNERS]
+    owners = [owner for owner in owners if owner is not None]
+    used = set()
+    for owner in owners:
+        owner._collect_attrs(used)
+    table = []
+    index = {}
+    mapping = {}
+    for value in used:
+        if value < 0:
+            key = _EXT_TABLE[~value]
+            index[key] = len(table)
+            if value != ~len(table):
+                mapping[value] = ~len(table)
+            table.append(key)
+    if mapping:
+        for owner in owners:
+            owner._remap_attrs(mapping)
+    _EXT_TABLE, _EXT_INDEX = table, index
+    _SGR_CACHE.clear()
+
+
+def _current_table():
+    """ returns the table the words made from now on index """
+    return _EXT_TABLE
+
+
+def _split(value, table=None):
+    if value >> _ATTR_EXT:
+        if table is None:
+            table = _EXT_TABLE
+        return table[~value]
+    return value, _EXT_NONE
+
+
+def _rgb_to_index(rgb):
+    """
+    Picks the nearest color of the xterm 256 color palette.
+
+    >>> _rgb_to_index(0xff0000), _rgb_to_index(0x808080), _rgb_to_index(0x5f87af)
+    (196, 244, 67)
+    """
+    r, g, b = rgb >> 16, rgb >> 8 & 0xff, rgb & 0xff
+    cube = [(c - 35) / 40 if c >= 75 else 0 for c in (r, g, b)]
+    levels = [0 if i == 0 else 55 + i * 40 for i in cube]
+    distance = sum((x - y) ** 2 for x, y in zip((r, g, b), levels))
+    gray = min(23, max(0, ((r + g + b) / 3 - 3) / 10))
+    level = 8 + gray * 10
+    if sum((x - level) ** 2 for x in (r, g, b)) < distance:
+        return 232 + gray
+    return 16 + cube[0] * 36 + cube[1] * 6 + cube[2]
+
+
+def _ext_params(extras, base):
+    flags, underline, fg, bg, ulcolor = extras
+    params = []
+    if flags & _EXT_FAINT:
+        params.append(2)
+    if flags & _EXT_ITALIC:
+        params.append(3)
+    if flags & _EXT_STRIKE:
+        params.append(9)
+    if underline > 1:
+        params.append('4:%d' % underline)
+    if fg != -1:
+        params.extend((38, 2, fg >> 16, fg >> 8 & 0xff, fg & 0xff))
+    if bg != -1:
+        params.extend((48, 2, bg >> 16, bg >> 8 & 0xff, bg & 0xff))
+    if ulcolor != -1:
+        if ulcolor & _EXT_RGB:
+            params.extend((58, 2, ulcolor >> 16 & 0xff,
+                           ulcolor >> 8 & 0xff, ulcolor & 0xff))
+        else:
+            params.extend((58, 5, ulcolor))
+    return params
+
+
+def _truecolor(group, i):
+    """ reads r, g, b of '38;2;r;g;b' or '38:2:[colorspace]:r:g:b' """
+    if len(group) - i > 3:
+        i += 1
+    r, g, b = group[i:i + 3]
+    return (r & 0xff) << 16 | (g & 0xff) << 8 | b & 0xff
+
+
+def _sgr_params(value, table=None):
+    """
+    >>> attr = Attribute()
+    >>> attr.set_sgr(iter([38, 5, 48, 48, 2, 1, 2, 3]))
+    >>> _sgr_params(attr._attrvalue)
+    [38, 5, 48, 48, 2, 1, 2, 3]
+    >>> attr.set_sgr(iter([0, 38, 2, 1, 2, 3, 48, 5, 38]))
+    >>> _sgr_params(attr._attrvalue)
+    [48, 5, 38, 38, 2, 1, 2, 3]
+    """
+    if value >> _ATTR_EXT:
+        base, extras = _split(value, table)
+        # a channel with an rgb color is emitted by _ext_params alone
+        params = _base_params(base, extras[2] == -1, extras[3] == -1)
+        return params + _ext_params(extras, base)
+    return _base_params(value, True, True)
+
+
+def _base_params(value, withfg, withbg):
+    params = []
+    for i in (1, 4, 5, 7, 8):
+        if value & (1 << i) != 0:
+            params.append(i)
+
+    fg = value >> _ATTR_FG & 0x1ff
+    if fg == 0x100 or not withfg:
+        pass
+    elif fg < 8:
+        params.append(30 + fg)
+    elif fg < 16:
+        params.append(90 + fg - 8)
+    else:
+        params.extend((38, 5, fg))
+
+    bg = value >> _ATTR_BG & 0x1ff
+    if bg == 0x100 or not withbg:
+        pass
+    elif bg < 8:
+        params.append(40 + bg)
+    elif bg < 16:
+        params.append(100 + bg - 8)
+    else:
+        params.extend((48, 5, bg))
+
+    return params
+
+
+def _sgr_delta(current, value):
+    if (current | value) >> _ATTR_EXT:
+        return None
+    params = []
+    for i, off in ((1, 22), (4, 24), (5, 25), (7, 27), (8, 28)):
+        bit = 1 << i
+        if value & bit != current & bit:
+            if value & bit:
+                params.append(i)
+            else:
+                params.append(off)
+                if i == 1:
+                    # some emulators (including ours) clear underline
+                    # with SGR 22, so turning bold off needs a reset
+                    return None
+
+    mask = 0x1ff << _ATTR_FG
+    if value & mask != current & mask:
+        fg = value >> _ATTR_FG & 0x1ff
+        if fg == 0x100:
+            params.append(39)
+        elif fg < 8:
+            params.append(30 + fg)
+        elif fg < 16:
+            params.append(90 + fg - 8)
+        else:
+            params.extend((38, 5, fg))
+
+    mask = 0x1ff << _ATTR_BG
+    if value & mask != current & mask:
+        bg = value >> _ATTR_BG & 0x1ff
+        if bg == 0x100:
+            params.append(49)
+        elif bg < 8:
+            params.append(40 + bg)
+        elif bg < 16:
+            params.append(100 + bg - 8)
+        else:
+            params.extend((48, 5, bg))
+
+    return params
+
+
+def _encode_sgr(current, value, table=None):
+    """
+    Builds the sequence emitted by Attribute.draw. When the current state
+    is known, the shorter of the delta form and the reset form is chosen.
+
+    >>> print _encode_sgr(None, _ATTR_DEFAULT).replace("\x1b", "<ESC>")
+    <ESC>[0m
+    >>> print _encode_sgr(_ATTR_DEFAULT, _ATTR_DEFAULT | 1 << _ATTR_INVERSE).replace("\x1b", "<ESC>")
+    <ESC>[7m
+    >>> print _encode_sgr(_ATTR_DEFAULT | 1 << _ATTR_BOLD, _ATTR_DEFAULT | 1 << _ATTR_INVERSE).replace("\x1b", "<ESC>")
+    <ESC>[0;7m
+    """
+    prefix = u''
+    if current is None:
+        value_current = _ATTR_DEFAULT
+    else:
+        value_current = _split(current, table)[0]
+
+    charset = _split(value, table)[0] & 0xf << 9
+    if charset != value_current & 0xf << _ATTR_NRC:
+        if len(_NRC_REVERSE_MAP) > charset:
+            prefix = u'\x1b(%c' % _NRC_REVERSE_MAP[charset]
+
+    sequence = u'\x1b[%sm' % ';'.join([str(p) for p in [0] + _sgr_params(value, table)])
+    if current is not None:
+        if current == value:
+            return prefix
+        params = _sgr_delta(current, value)
+        if params is not None:
+            delta = u'\x1b[%sm' % ';'.join([str(p) for p in params])
+            if len(delta) < len(sequence):
+                sequence = delta
+    return prefix + sequence
+
+
+_SGR_CACHE = {}
+_SGR_CACHE_MAX = 4096
+
+
+def get_sgr(current, value):
+    """
+    Returns the sequence which turns the attribute word current (None if
+    unknown) into value. Render loops compare the words themselves and
+    call this only when they differ.
+
+    >>> print get_sgr(_ATTR_DEFAULT, _ATTR_DEFAULT | 1 << _ATTR_BOLD).replace("\x1b", "<ESC>")
+    <ESC>[1m
+    """
+    key = (current, value)
+    try:
+        return _SGR_CACHE[key]
+    except KeyError:
+        if len(_SGR_CACHE) >= _SGR_CACHE_MAX:
+            _SGR_CACHE.clear()
+        sequence = _SGR_CACHE[key] = _encode_sgr(current, value)
+        return sequence
+
+
 class Attribute():
 
     """
@@ -72,6 +428,22 @@ class Attribute():
     >>> attr.set_sgr(x for x in (38, 5, 200, 48, 5, 100))
     >>> print attr
     <ESC>[0;5;7;8;38;5;200;48;5;100m
+    >>> attr = Attribute()
+    >>> attr.set_sgr(iter([1, 3, 38, 2, 255, 128, 0, 48, 5, 17]))
+    >>> print attr
+    <ESC>[0;1;48;5;17;3;38;2;255;128;0m
+    >>> other = Attribute()
+    >>> other.set_sgr(iter([3, 1, 48, 5, 17, 38, 2, 255, 128, 0]))
+    >>> other.equals(attr)
+    True
+    >>> attr.set_sgr(iter([(4, 3), (58, 2, 0, 1, 2, 3), 23, 39]))
+    >>> print attr
+    <ESC>[0;1;4;48;5;17;4:3;58;2;1;2;3m
+    >>> attr.set_sgr(iter([24, 59, 22]))
+    >>> print attr
+    <ESC>[0;48;5;17m
+    >>> attr.equals(Attribute(attr.getbcevalue()))
+    True
     """
 
     _attrvalue = _ATTR_DEFAULT
@@ -86,41 +458,26 @@ class Attribute():
         self._attrvalue = value
 
     def draw(self, s, attr=None):
-        params = [0]
-        if attr:
-            value_current = attr._attrvalue
-        else:
-            value_current = _ATTR_DEFAULT
-        value = self._attrvalue
-        for i in (1, 4, 5, 7, 8):
-            if value & (1 << i) != 0:
-                params.append(i)
-
-        fg = value >> _ATTR_FG & 0x1ff
-        if fg == 0x100:
-            pass
-        elif fg < 8:
-            params.append(30 + fg)
-        elif fg < 16:
-            params.append(90 + fg - 8)
-        else:
-            params.extend((38, 5, fg))
+        """
+        Writes the SGR sequence which turns the attribute of the terminal
+        from attr (or an unknown state, if it is None) into this one.
 
-        bg = value >> _ATTR_BG & 0x1ff
-        if bg == 0x100:
-            pass
-        elif bg < 8:
-            params.append(40 + bg)
-        elif bg < 16:
-            params.append(100 + bg - 8)
+        >>> import StringIO
+        >>> s = StringIO.StringIO()
+        >>> red = Attribute()
+        >>> red.set_sgr(x for x in (1, 31))
+        >>> underlined = Attribute()
+        >>> underlined.set_sgr(x for x in (1, 4, 31))
+        >>> underlined.draw(s, red)
+        >>> red.draw(s, underlined)
+        >>> Attribute().draw(s, underlined)
+        >>> print s.getvalue().replace("\x1b", "<ESC>")
+        <ESC>[4m<ESC>[24m<ESC>[0m
+        """
+        if attr is None:
+            s.write(get_sgr(None, self._attrvalue))
         else:
-            params.extend((48, 5, bg))
-
-        charset = value & 0xf << 9
-        if charset != value_current & 0xf << _ATTR_NRC:
-            if len(_NRC_REVERSE_MAP) > charset:
-                s.write(u'\x1b(%c' % _NRC_REVERSE_MAP[charset])
-        s.write(u'\x1b[%sm' % ';'.join([str(p) for p in params]))
+            s.write(get_sgr(attr._attrvalue, self._attrvalue))
 
     def clear(self):
         self._attrvalue = _ATTR_DEFAULT
@@ -133,82 +490,184 @@ class Attribute():
 
     def getbcevalue(self):
         value = self._attrvalue
+        if value >> _ATTR_EXT:
+            base, extras = _split(value)
+            return _intern(base & (0x3ffff << _ATTR_FG),
+                           (0, 0, extras[2], extras[3], -1))
         return value & (0x3ffff << _ATTR_FG)
 
     def getdefaultvalue(self):
         return _ATTR_DEFAULT
 
     def set_charset(self, charset):
-        value = self._attrvalue
+        base, extras = _split(self._attrvalue)
         try:
             code = _NRC_MAP[charset]
-            self._attrvalue = value & ~(0xf << _ATTR_NRC) | (code << _ATTR_NRC)
+            base = base & ~(0xf << _ATTR_NRC) | (code << _ATTR_NRC)
+            self._attrvalue = _intern(base, extras)
         except ValueError:
             return False
         return True
 
     def set_sgr(self, pm):
-        i = 0
         value = self._attrvalue
+        if value >> _ATTR_EXT:
+            value, extras = _split(value)
+            flags, underline, fg, bg, ulcolor = extras
+        else:
+            flags, underline, fg, bg, ulcolor = _EXT_NONE
         for n in pm:
+            if n.__class__ is tuple:
+                # colon separated sub-parameters, e.g. 4:3 or 38:2::r:g:b
+                group = n
+                n = group[0]
+                if n == 4:
+                    underline = group[1]
+                    if underline:
+                        value |= 1 << _ATTR_UNDERLINED
+                    else:
+                        value &= ~(1 << _ATTR_UNDERLINED)
+                    if underline == 1:
+                        # a plain underline needs no extras
+                        underline = 0
+                elif n == 38 or n == 48 or n == 58:
+                    mode = group[1]
+                    if mode == 2:
+                        color = _truecolor(group, 2)
+                    elif mode == 5:
+                        color = group[2]
+                    else:
+                        continue
+                    value, fg, bg, ulcolor = self._set_color(value, fg, bg, ulcolor,
+                                                             n, mode, color)
+                continue
             if n < 10:
                 if n == 0:
                     value = _ATTR_DEFAULT
+                    flags, underline, fg, bg, ulcolor = _EXT_NONE
                 elif n == 1:
                     value |= 1 << _ATTR_BOLD
                 elif n == 4:
                     value |= 1 << _ATTR_UNDERLINED
+                    underline = 0
                 elif n == 5:
                     value |= 1 << _ATTR_BLINK
                 elif n == 7:
                     value |= 1 << _ATTR_INVERSE
                 elif n == 8:
                     value |= 1 << _ATTR_INVISIBLE
+                elif n == 2:
+                    flags |= _EXT_FAINT
+                elif n == 3:
+                    flags |= _EXT_ITALIC
+                elif n == 9:
+                    flags |= _EXT_STRIKE
             elif n < 30:
                 if n == 21:
                     value &= ~(1 << _ATTR_BOLD)
                 elif n == 22:
                     value &= ~(1 << _ATTR_BOLD | 1 << _ATTR_UNDERLINED)
+                    flags &= ~_EXT_FAINT
+                    underline = 0
+                elif n == 23:
+                    flags &= ~_EXT_ITALIC
                 elif n == 24:
                     value &= ~(1 << _ATTR_UNDERLINED)
+                    underline = 0
                 elif n == 25:
                     value &= ~(1 << _ATTR_BLINK)
                 elif n == 27:
                     value &= ~(1 << _ATTR_INVERSE)
                 elif n == 28:
                     value &= ~(1 << _ATTR_INVISIBLE)
+                elif n == 29:
+                    flags &= ~_EXT_STRIKE
             elif n < 40:
                 if n == 38:
-                    if pm.next() == 5:
-                        value &= ~(0x1ff << _ATTR_FG)
-                        value |= pm.next() << _ATTR_FG
+                    mode = pm.next()
+                    if mode == 5:
+                        color = pm.next()
+                    elif mode == 2:
+                        color = _truecolor((pm.next(), pm.next(), pm.next()), 0)
+                    else:
+                        continue
+                    value, fg, bg, ulcolor = self._set_color(value, fg, bg, ulcolor,
+                                                             n, mode, color)
                 elif n == 39:
                     value &= ~(0x1ff << _ATTR_FG)
                     value |= 0x100 << _ATTR_FG
+                    fg = -1
                 else:
                     value &= ~(0x1ff << _ATTR_FG)
                     value |= (n - 30) << _ATTR_FG
+                    fg = -1
             elif n < 50:
                 if n == 48:
-                    if pm.next() == 5:
-                        value &= ~(0x1ff << _ATTR_BG)
-                        value |= pm.next() << _ATTR_BG
+                    mode = pm.next()
+                    if mode == 5:
+                        color = pm.next()
+                    elif mode == 2:
+                        color = _truecolor((pm.next(), pm.next(), pm.next()), 0)
+                    else:
+                        continue
+                    value, fg, bg, ulcolor = self._set_color(value, fg, bg, ulcolor,
+                                                             n, mode, color)
                 elif n == 49:
                     value &= ~(0x1ff << _ATTR_BG)
                     value |= 0x100 << _ATTR_BG
+                    bg = -1
                 else:
                     value &= ~(0x1ff << _ATTR_BG)
                     value |= (n - 40) << _ATTR_BG
+                    bg = -1
             elif 90 <= n and n < 98:
                 value &= ~(0x1ff << _ATTR_FG)
                 value |= (n - 90 + 8) << _ATTR_FG
+                fg = -1
             elif 100 <= n and n < 108:
                 value &= ~(0x1ff << _ATTR_BG)
                 value |= (n - 100 + 8) << _ATTR_BG
+                bg = -1
+            elif n == 58:
+                mode = pm.next()
+                if mode == 5:
+                    color = pm.next()
+                elif mode == 2:
+                    color = _truecolor((pm.next(), pm.next(), pm.next()), 0)
+                else:
+                    continue
+                value, fg, bg, ulcolor = self._set_color(value, fg, bg, ulcolor,
+                                                         n, mode, color)
+            elif n == 59:
+                ulcolor = -1
             #logger.writeLine("SGR %d is ignored." % n)
-            i += 1
+        if flags or underline or fg != -1 or bg != -1 or ulcolor != -1:
+            value = _intern(value, (flags, underline, fg, bg, ulcolor))
         self._attrvalue = value
 
+    def _set_color(self, value, fg, bg, ulcolor, n, mode, color):
+        """ applies 38/48/58 with mode 5 (index) or 2 (rgb) """
+        if n == 58:
+            if mode == 2:
+                ulcolor = _EXT_RGB | color
+            else:
+                ulcolor = color & 0xff
+            return value, fg, bg, ulcolor
+        if mode == 2:
+            index = _rgb_to_index(color)
+        else:
+            index = color & 0xff
+            color = -1
+        if n == 38:
+            value &= ~(0x1ff << _ATTR_FG)
+            value |= index << _ATTR_FG
+            fg = color
+        else:
+            value &= ~(0x1ff << _ATTR_BG)
+            value |= index << _ATTR_BG
+            bg = color
+        return value, fg, bg, ulcolor
+
     def equals(self, other):
         return self._attrvalue == other._attrvalue
 
@@ -34,10 +34,12 @@ class Cursor():
     attr = None
     _backup = None
 
-    def __init__(self, y=0, x=0, attr=Attribute()):
+    def __init__(self, y=0, x=0, attr=None):
         self.col = x
         self.row = y
         self.dirty = True
+        if attr is None:
+            attr = Attribute()
         self.attr = attr
         self._backup = None
 
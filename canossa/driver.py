@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+import os
+import errno
+import logging
+
+from stub import tff
+from output import _Discard
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+_FRAME_INTERVAL = 1.0 / 60
+_READ_SIZE = 65536
+
+
+def _set_winsize(fd, row, col):
+    import fcntl
+    import struct
+    import termios
+    winsize = struct.pack('HHHH', row, col, 0, 0)
+    fcntl.ioctl(fd, termios.TIOCSWINSZ, winsize)
+
+
+class _FdWriter():
+    '''
+    writes to a non-blocking pty master.  what the pty does not take at
+    once is kept and sent when the loop finds the fd writable.
+    '''
+
+    def __init__(self, fd, loop):
+        self._fd = fd
+        self._loop = loop
+        self._pending = ''
+
+    def write(self, data):
+        if self._pending:
+            self._pending += data
+            return
+        data = data[self._send(data):]
+        if data:
+            self._pending = data
+            self._loop.add_writer(self._fd, self._drain)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        if self._pending:
+            self._pending = ''
+            self._loop.remove_writer(self._fd)
+
+    def _send(self, data):
+        try:
+            return os.write(self._fd, data)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return 0
+            raise
+
+    def _drain(self):
+        try:
+            self._pending = self._pending[self._send(self._pending):]
+        except OSError, e:
+            # the application went away, _read() detaches the terminal
+            logging.exception(e)
+            self._pending = ''
+        if not self._pending:
+            self._loop.remove_writer(self._fd)
+
+
+class AsyncTerminal():
+    '''
+    a pty master fed into a canossa handler by AsyncDriver.  with an
+    output, the master is parsed on a context writing to it.  without one,
+    it goes through canossa.feed(): replies are written back to the master
+    and unhandled sequences are dropped.
+    '''
+
+    def __init__(self, fd, canossa, output, termenc, onclose, loop):
+        self.fd = fd
+        self.canossa = canossa
+        self.pid = None
+        self.dirty = False
+        self.onclose = onclose
+        self.writer = _FdWriter(fd, loop)
+        if output is None:
+            output = _Discard()
+            self.parser = None
+        else:
+            self.parser = tff.DefaultParser()
+        # every terminal needs its own scanner, it keeps the state of
+        # the incremental decoder between chunks
+        self.context = tff.ParseContext(output=output,
+                                        termenc=termenc,
+                                        scanner=tff.DefaultScanner(),
+                                        handler=canossa,
+                                        buffering=False)
+        if self.parser is not None:
+            self.parser.init(self.context)
+
+    def write(self, data):
+        ''' send input to the application '''
+        self.writer.write(data)
+
+    def parse(self, data):
+        if self.parser is None:
+            replies = self.canossa.feed(data)
+            if replies:
+                self.writer.write(replies)
+        else:
+            self.parser.parse(data)
+
+
+class AsyncDriver():
+    '''
+    Drives many canossa instances from one event loop.  Each pty master is
+    read with loop.add_reader() and fed to its parser as it arrives, while
+    handle_draw() is deferred to a frame timer so a burst of output is drawn
+    once per frame rather than once per read.
+
+    The loop only needs add_reader(), remove_reader(), add_writer(),
+    remove_writer() and call_later(), so any asyncio (or trollius)
+    compatible loop can be passed in.
+
+    >>> import StringIO
+    >>> import screen, output
+    >>> class Loop():
+    ...     def __init__(self):
+    ...         self.readers = {}
+    ...         self.timers = []
+    ...     def add_reader(self, fd, callback, *args):
+    ...         self.readers[fd] = (callback, args)
+    ...     def remove_reader(self, fd):
+    ...         del self.readers[fd]
+    ...     def call_later(self, delay, callback, *args):
+    ...         self.timers.append((callback, args))
+    ...         return callback
+    ...     def poll(self, fd):
+    ...         callback, args = self.readers[fd]
+    ...         callback(*args)
+    ...     def tick(self):
+    ...         timers, self.timers = self.timers, []
+    ...         for callback, args in timers:
+    ...             callback(*args)
+    >>> loop = Loop()
+    >>> driver = AsyncDriver(loop=loop)
+    >>> s = screen.Screen(2, 10, 0, 0, 'UTF-8', screen.DummyTermprop())
+    >>> canossa = output.Canossa(screen=s, resized=False)
+    >>> r, w = os.pipe()
+    >>> closed = []
+    >>> terminal = driver.attach(r, canossa, StringIO.StringIO(),
+    ...                          onclose=closed.append)
+    >>> os.write(w, 'abc')
+    3
+    >>> loop.poll(r)
+    >>> os.write(w, '\\x1b[2;3Hxyz')
+    9
+    >>> loop.poll(r)
+    >>> len(loop.timers)
+    1
+    >>> s.get_lines()
+    [u'abc', u'  xyz']
+    >>> drawn = []
+    >>> canossa.handle_draw = lambda context: drawn.append(context)
+    >>> loop.tick()
+    >>> len(drawn)
+    1
+    >>> loop.timers
+    []
+    >>> os.close(w)
+    >>> loop.poll(r)
+    >>> closed == [terminal]
+    True
+    >>> loop.readers
+    {}
+    >>> os.close(r)
+
+    Without an output, replies go back to the fd and nothing else does:
+
+    >>> import socket
+    >>> a, b = socket.socketpair()
+    >>> terminal = driver.attach(a.fileno(), canossa, None)
+    >>> b.sendall('\\x1b]7;file://host/tmp\\x07\\x1b[1;1H\\x1b[6n')
+    >>> loop.poll(a.fileno())
+    >>> b.recv(64)
+    '\\x1b[1;1R'
+    >>> driver.close()
+    >>> a.close(), b.close()
+    (None, None)
+    '''
+
+    def __init__(self, loop=None, interval=_FRAME_INTERVAL):
+        if loop is None:
+            if asyncio is None:
+                raise ImportError('AsyncDriver needs asyncio or trollius.')
+            loop = asyncio.get_event_loop()
+        self._loop = loop
+        self._interval = interval
+        self._terminals = {}
+        self._dirty = []
+        self._frame = None
+
+    def attach(self, fd, canossa, output, termenc='UTF-8', onclose=None):
+        '''
+        start feeding the output of fd into canossa.  without output,
+        fd is parsed with canossa.feed() and its replies are written to fd.
+        '''
+        terminal = AsyncTerminal(fd, canossa, output, termenc, onclose,
+                                 self._loop)
+        self._terminals[fd] = terminal
+        canossa.handle_start(terminal.context)
+        self._loop.add_reader(fd, self._read, terminal)
+        return terminal
+
+    def spawn(self, command, row, col, canossa, output=None,
+              termenc='UTF-8', term='xterm', onclose=None):
+        '''
+        run command on a new pty and attach its master.  without output,
+        only replies (CPR, DA responses) go back to the pty.
+        '''
+        import pty
+        import fcntl
+
+        pid, fd = pty.fork()
+        if pid == 0:
+            os.environ['TERM'] = term
+            try:
+                os.execvp('/bin/sh', ['/bin/sh', '-c', command])
+            finally:
+                os._exit(127)
+        _set_winsize(fd, row, col)
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        terminal = self.attach(fd, canossa, output, termenc, onclose)
+        terminal.pid = pid
+        return terminal
+
+    def resize(self, terminal, row, col):
+        ''' resize the screen, and the pty if spawn() made it '''
+        if terminal.pid is not None:
+            _set_winsize(terminal.fd, row, col)
+        terminal.canossa.handle_resize(terminal.context, row, col)
+
+    def detach(self, terminal):
+        ''' stop reading terminal; its fd is left open '''
+        if self._terminals.pop(terminal.fd, None) is None:
+            return
+        self._loop.remove_reader(terminal.fd)
+        if terminal.dirty:
+            terminal.dirty = False
+            self._dirty.remove(terminal)
+        terminal.canossa.handle_end(terminal.context)
+        terminal.writer.close()
+        if terminal.pid is not None:
+            os.close(terminal.fd)
+            try:
+                os.waitpid(terminal.pid, os.WNOHANG)
+            except OSError:
+                pass
+        if terminal.onclose:
+            terminal.onclose(terminal)
+
+    def close(self):
+        ''' detach every terminal and stop the frame timer '''
+        for terminal in self._terminals.values():
+            self.detach(terminal)
+        if self._frame is not None and hasattr(self._frame, 'cancel'):
+            self._frame.cancel()
+        self._frame = None
+
+    def flush(self):
+        ''' draw every dirty terminal now '''
+        dirty = self._dirty
+        self._dirty = []
+        for terminal in dirty:
+            terminal.dirty = False
+            terminal.canossa.handle_draw(terminal.context)
+            terminal.context.flush()
+
+    def _read(self, terminal):
+        try:
+            data = os.read(terminal.fd, _READ_SIZE)
+        except OSError, e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            # a pty master raises EIO once the slave side is closed
+            data = None
+        if not data:
+            self.detach(terminal)
+            return
+        terminal.parse(data)
+        if not terminal.dirty:
+            terminal.dirty = True
+            self._dirty.append(terminal)
+        if self._frame is None:
+            self._frame = self._loop.call_later(self._interval, self._tick)
+
+    def _tick(self):
+        self._frame = None
+        self.flush()
+
+
@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+import time
+import select
+import errno
+import logging
+import threading
+import multiprocessing
+
+from driver import AsyncDriver
+
+
+class _Timer():
+
+    def __init__(self, when, callback, args):
+        self.when = when
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class _SelectLoop():
+    ''' the part of the asyncio loop interface AsyncDriver uses, on select() '''
+
+    def __init__(self):
+        self._readers = {}
+        self._writers = {}
+        self._timers = []
+        self._running = False
+
+    def add_reader(self, fd, callback, *args):
+        self._readers[fd] = (callback, args)
+
+    def remove_reader(self, fd):
+        self._readers.pop(fd, None)
+
+    def add_writer(self, fd, callback, *args):
+        self._writers[fd] = (callback, args)
+
+    def remove_writer(self, fd):
+        self._writers.pop(fd, None)
+
+    def call_later(self, delay, callback, *args):
+        timer = _Timer(time.time() + delay, callback, args)
+        self._timers.append(timer)
+        return timer
+
+    def stop(self):
+        self._running = False
+
+    def run_forever(self):
+        self._running = True
+        while self._running:
+            timeout = None
+            if self._timers:
+                when = min(timer.when for timer in self._timers)
+                timeout = max(0, when - time.time())
+            try:
+                rfds, wfds, xfds = select.select(self._readers.keys(),
+                                                 self._writers.keys(),
+                                                 [], timeout)
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for fd in rfds:
+                # an earlier callback may have removed this reader
+                if fd in self._readers:
+                    callback, args = self._readers[fd]
+                    callback(*args)
+            for fd in wfds:
+                if fd in self._writers:
+                    callback, args = self._writers[fd]
+                    callback(*args)
+            if self._timers:
+                now = time.time()
+                due = [timer for timer in self._timers if timer.when <= now]
+                if due:
+                    self._timers = [timer for timer in self._timers
+                                    if timer.when > now]
+                    for timer in due:
+                        if not timer.cancelled:
+                            timer.callback(*timer.args)
+
+
+class _Session():
+
+    def __init__(self, screen, canossa, terminal):
+        self.screen = screen
+        self.canossa = canossa
+        self.terminal = terminal
+
+
+class _Worker():
+    ''' runs in a child process and owns the Screens of its sessions '''
+
+    def __init__(self, conn, cjk, interval):
+        self._conn = conn
+        self._cjk = cjk
+        self._sessions = {}
+        self._loop = _SelectLoop()
+        self._driver = AsyncDriver(loop=self._loop, interval=interval)
+
+    def run(self):
+        self._loop.add_reader(self._conn.fileno(), self._serve)
+        self._loop.run_forever()
+        self._driver.close()
+
+    def _serve(self):
+        try:
+            message = self._conn.recv()
+        except EOFError:
+            self._loop.stop()
+            return
+        op = message[0]
+        try:
+            result = getattr(self, '_op_' + op)(*message[1:])
+        except Exception, e:
+            if op in _REPLY_OPS:
+                self._conn.send(('error', e))
+            else:
+                logging.exception(e)
+        else:
+            if op in _REPLY_OPS:
+                self._conn.send(('ok', result))
+
+    def _op_open(self, sid, row, col, termenc, command):
+        import screen
+        import output
+        import termprop
+
+        prop = termprop.MockTermprop()
+        if self._cjk:
+            prop.set_cjk()
+        s = screen.Screen(row, col, 0, 0, termenc, prop)
+        canossa = output.Canossa(screen=s, resized=False)
+        if command is None:
+            terminal = None
+        else:
+            terminal = self._driver.spawn(command, row, col, canossa,
+                                          termenc=termenc)
+        self._sessions[sid] = _Session(s, canossa, terminal)
+
+    def _op_close(self, sid):
+        session = self._sessions.pop(sid)
+        if session.terminal is not None:
+            self._driver.detach(session.terminal)
+
+    def _op_feed(self, sid, data):
+        session = self._sessions[sid]
+        if session.terminal is None:
+            session.canossa.feed(data)
+        else:
+            session.terminal.parse(data)
+
+    def _op_write(self, sid, data):
+        terminal = self._sessions[sid].terminal
+        if terminal is None:
+            raise ValueError('session %d has no pty' % sid)
+        if terminal.fd not in self._driver._terminals:
+            raise IOError(errno.EIO, 'session %d has exited' % sid)
+        terminal.write(data)
+
+    def _op_resize(self, sid, row, col):
+        session = self._sessions[sid]
+        if session.terminal is None:
+            session.screen.resize(row, col)
+        else:
+            self._driver.resize(session.terminal, row, col)
+
+    def _op_alive(self, sid):
+        session = self._sessions[sid]
+        if session.terminal is None:
+            return True
+        return session.terminal.fd in self._driver._terminals
+
+    def _op_cursor(self, sid):
+        return self._sessions[sid].screen.getyx()
+
+    def _op_snapshot(self, sid):
+        return self._sessions[sid].screen.snapshot()
+
+    def _op_lines(self, sid, start, end, strip):
+        return self._sessions[sid].screen.get_lines(start, end, strip)
+
+    def _op_text(self, sid, rect, strip):
+        return self._sessions[sid].screen.get_text(rect, strip)
+
+    def _op_sync(self):
+        return None
+
+    def _op_quit(self):
+        self._loop.stop()
+
+_REPLY_OPS = set(['write', 'alive', 'cursor', 'snapshot', 'lines', 'text',
+                  'sync'])
+
+
+def _run_worker(conn, cjk, interval):
+    _Worker(conn, cjk, interval).run()
+
+
+class SessionHost():
+    '''
+    Shards headless sessions across worker processes, so parsing for
+    different ptys runs on different cores.  Each worker owns the Screen
+    and Canossa of its sessions; snapshots and text come back over a pipe.
+    A session either runs a command on its own pty or is fed by feed().
+
+    >>> host = SessionHost(workers=2)
+    >>> a = host.open(3, 10)
+    >>> b = host.open(3, 10)
+    >>> host.feed(a, 'hello\\r\\n\\x1b[31mworld')
+    >>> host.feed(b, 'abc\\x1b[2;2Hxyz')
+    >>> host.get_lines(a)
+    [u'hello', u'world', u'']
+    >>> host.get_text(b, (1, 0, 3, 2))
+    u'bc\\nxyz'
+    >>> host.getyx(b)
+    (1, 4)
+    >>> data = host.snapshot(a)
+    >>> data[:4]
+    'CNSS'
+    >>> host.resize(a, 2, 8)
+    >>> host.get_lines(a)
+    [u'hello', u'world']
+    >>> c = host.open(2, 20, command='printf spawned; sleep 1')
+    >>> for i in xrange(0, 100):
+    ...     if host.get_lines(c)[0]:
+    ...         break
+    ...     time.sleep(0.05)
+    >>> host.get_lines(c)
+    [u'spawned', u'']
+    >>> host.write(a, 'ls\\r')
+    Traceback (most recent call last):
+        ...
+    ValueError: session 0 has no pty
+    >>> d = host.open(3, 20, command='cat')
+    >>> host.write(d, 'hi\\r')
+    >>> for i in xrange(0, 100):
+    ...     if host.get_lines(d)[1]:
+    ...         break
+    ...     time.sleep(0.05)
+    >>> host.get_lines(d)
+    [u'hi', u'hi', u'']
+    >>> host.close(b)
+    >>> host.get_lines(b)
+    Traceback (most recent call last):
+        ...
+    KeyError: 1
+    >>> host.shutdown()
+    '''
+
+    def __init__(self, workers=None, cjk=False, interval=1.0 / 60):
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        self._workers = []
+        for i in xrange(0, workers):
+            conn, child = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_worker,
+                                              args=(child, cjk, interval))
+            process.daemon = True
+            process.start()
+            child.close()
+            self._workers.append((process, conn, threading.Lock(), []))
+        self._sessions = {}
+        self._serial = 0
+
+    def _send(self, sid, *message):
+        process, conn, lock, sids = self._workers[self._sessions[sid]]
+        lock.acquire()
+        try:
+            conn.send(message)
+        finally:
+            lock.release()
+
+    def _call(self, worker, *message):
+        process, conn, lock, sids = self._workers[worker]
+        lock.acquire()
+        try:
+            conn.send(message)
+            status, value = conn.recv()
+        finally:
+            lock.release()
+        if status == 'error':
+            raise value
+        return value
+
+    def _request(self, sid, *message):
+        return self._call(self._sessions[sid], *message)
+
+    def open(self, row, col, termenc='UTF-8', command=None):
+        ''' create a session on the least loaded worker, return its id '''
+        loads = [len(sids) for process, conn, lock, sids in self._workers]
+        worker = loads.index(min(loads))
+        sid = self._serial
+        self._serial += 1
+        self._sessions[sid] = worker
+        self._workers[worker][3].append(sid)
+        self._send(sid, 'open', sid, row, col, termenc, command)
+        return sid
+
+    def close(self, sid):
+        self._send(sid, 'close', sid)
+        worker = self._sessions.pop(sid)
+        self._workers[worker][3].remove(sid)
+
+    def feed(self, sid, data):
+        ''' parse data as output of the session's application '''
+        self._send(sid, 'feed', sid, data)
+
+    def write(self, sid, data):
+        ''' send input to the application running on the session's pty '''
+        self._request(sid, 'write', sid, data)
+
+    def resize(self, sid, row, col):
+        self._send(sid, 'resize', sid, row, col)
+
+    def is_alive(self, sid):
+        return self._request(sid, 'alive', sid)
+
+    def getyx(self, sid):
+        return self._request(sid, 'cursor', sid)
+
+    def snapshot(self, sid):
+        return self._request(sid, 'snapshot', sid)
+
+    def get_lines(self, sid, start=0, end=None, strip=True):
+        return self._request(sid, 'lines', sid, start, end, strip)
+
+    def get_text(self, sid, rect=None, strip=True):
+        return self._request(sid, 'text', sid, rect, strip)
+
+    def sync(self):
+        ''' wait until every worker has handled what was sent so far '''
+        for worker in xrange(0, len(self._workers)):
+            self._call(worker, 'sync')
+
+    def shutdown(self):
+        # the other workers hold inherited copies of each pipe, so closing
+        # our end is not enough to make a worker see EOF
+        for process, conn, lock, sids in self._workers:
+            conn.send(('quit',))
+            conn.close()
+        for process, conn, lock, sids in self._workers:
+            process.join()
+        self._workers = []
+        self._sessions = {}
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    test()
+
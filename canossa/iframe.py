@@ -31,6 +31,8 @@ from interface import IInnerFrame, IInnerFrameListener, IWidget
 from output import Canossa
 from screen import Screen
 from exception import CanossaRangeException
+from widthtable import get_wcwidth, get_wcswidth
+import time
 
 _HITTEST_NONE              = 0
 _HITTEST_CLIENTAREA        = 1
@@ -77,6 +79,15 @@ _MOUSEEVENTTYPE_DRAGMOVE    = 0 | _MOUSEEVENTTYPE_MOVE
 _MOUSEEVENTTYPE_SCROLLDOWN  = 0 | _MOUSEEVENTTYPE_SCROLL
 _MOUSEEVENTTYPE_SCROLLUP    = 1 | _MOUSEEVENTTYPE_SCROLL
 
+_RESIZE_INTERVAL = 0.25  # seconds between resizes while dragging
+
+
+def _contains(spans, n):
+    for start, end in spans:
+        if start <= n < end:
+            return True
+    return False
+
 
 class Desktop(IWidget, IMouseListener):
 
@@ -335,6 +346,7 @@ class IMouseListenerImpl(IMouseListener):
         self.top += self.offset_top
         self.offset_left = 0
         self.offset_top = 0
+        self._apply_resize()
         self._dragtype = _DRAGTYPE_NONE
         self._dragpos = None
         self._titlestyle = _TITLESTYLE_ACTIVE
@@ -356,10 +368,10 @@ class IMouseListenerImpl(IMouseListener):
             offset_y = y - origin_y
 
             screen = self._outerscreen
-            innerscreen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
 
-            width = innerscreen.width + 2
-            height = innerscreen.height + 2
+            width = framewidth + 2
+            height = frameheight + 2
 
             if self.left + width + offset_x < 1:
                 offset_x = 1 - self.left - width
@@ -375,14 +387,12 @@ class IMouseListenerImpl(IMouseListener):
 
             left = self.left + self.offset_left - 1
             top = self.top + self.offset_top - 1
-            width = innerscreen.width + 2
-            height = innerscreen.height + 2
 
             self._window.realloc(left, top, width, height)
 
         elif self._dragtype == _DRAGTYPE_BOTTOMRIGHT:
 
-            screen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
             window = self._window
 
             left = self.left
@@ -390,8 +400,7 @@ class IMouseListenerImpl(IMouseListener):
             row = max(y - top, 5)
             col = max(x - left, 8)
 
-            screen.resize(row, col)
-            self._tty.resize(row, col)
+            self._request_resize(row, col)
 
             left -= 1
             top -= 1
@@ -402,16 +411,15 @@ class IMouseListenerImpl(IMouseListener):
 
         elif self._dragtype == _DRAGTYPE_BOTTOMLEFT:
 
-            screen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
             window = self._window
 
-            left = min(max(x + 1, 0), self.left + screen.width - 10)
+            left = min(max(x + 1, 0), self.left + framewidth - 10)
             top = self.top
             row = max(y - top, 5)
-            col = self.left + screen.width - left
+            col = self.left + framewidth - left
 
-            screen.resize(row, col)
-            self._tty.resize(row, col)
+            self._request_resize(row, col)
 
             left -= 1
             top -= 1
@@ -424,16 +432,15 @@ class IMouseListenerImpl(IMouseListener):
 
         elif self._dragtype == _DRAGTYPE_BOTTOM:
 
-            screen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
             window = self._window
 
             left = self.left
             top = self.top
             row = max(y - top, 5)
-            col = screen.width
+            col = framewidth
 
-            screen.resize(row, col)
-            self._tty.resize(row, col)
+            self._request_resize(row, col)
 
             left -= 1
             top -= 1
@@ -444,14 +451,14 @@ class IMouseListenerImpl(IMouseListener):
 
         elif self._dragtype == _DRAGTYPE_LEFT:
 
-            screen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
             outerscreen = self._outerscreen
             window = self._window
 
-            left = min(max(x + 1, 0), self.left + screen.width - 10)
+            left = min(max(x + 1, 0), self.left + framewidth - 10)
             top = self.top
-            row = screen.height
-            col = self.left + screen.width - left
+            row = frameheight
+            col = self.left + framewidth - left
 
             left -= 1
             top -= 1
@@ -461,8 +468,7 @@ class IMouseListenerImpl(IMouseListener):
             if left > outerscreen.width - 1:
                 return
 
-            screen.resize(row, col)
-            self._tty.resize(row, col)
+            self._request_resize(row, col)
 
             self.left = left + 1
 
@@ -470,12 +476,12 @@ class IMouseListenerImpl(IMouseListener):
 
         elif self._dragtype == _DRAGTYPE_RIGHT:
 
-            screen = self.innerscreen
+            frameheight, framewidth = self._getframesize()
             window = self._window
 
             left = self.left
             top = self.top
-            row = screen.height
+            row = frameheight
             col = max(x - left, 8)
 
             left -= 1
@@ -483,8 +489,7 @@ class IMouseListenerImpl(IMouseListener):
             width = col + 2
             height = row + 2
 
-            screen.resize(row, col)
-            self._tty.resize(row, col)
+            self._request_resize(row, col)
 
             window.realloc(left, top, width, height)
 
@@ -504,13 +509,15 @@ class IMouseListenerImpl(IMouseListener):
         return self.left + self.offset_left - self._padding_left
 
     def _get_right(self):
-        return self.left + self.offset_left + self.innerscreen.width + self._padding_right
+        frameheight, framewidth = self._getframesize()
+        return self.left + self.offset_left + framewidth + self._padding_right
 
     def _get_top(self):
         return self.top + self.offset_top - self._padding_top
 
     def _get_bottom(self):
-        return self.top + self.offset_top + self.innerscreen.height + self._padding_bottom
+        frameheight, framewidth = self._getframesize()
+        return self.top + self.offset_top + frameheight + self._padding_bottom
 
     def _hittest(self, x, y):
         screen = self.innerscreen
@@ -563,10 +570,52 @@ class IMouseListenerImpl(IMouseListener):
         else:
             assert False, 'Unknown mouse encoding is detected: %d' % encoding
 
+class SupportsCoalescedResizeTrait():
+    ''' Defers the resize of the inner screen and its tty during a drag.
+
+    While the border is dragged only the frame is redrawn at the new size
+    (an outline, the content is not reflowed), and the child is resized at
+    most once per resize_interval, and with the final size on drag end.
+    If resize_interval is None, only the final size is applied.
+    '''
+
+    resize_interval = _RESIZE_INTERVAL
+    _pending_size = None
+    _last_resize = 0
+
+    def _getframesize(self):
+        ''' returns the (row, col) the frame is drawn with '''
+        if self._pending_size:
+            return self._pending_size
+        innerscreen = self.innerscreen
+        return innerscreen.height, innerscreen.width
+
+    def _request_resize(self, row, col):
+        innerscreen = self.innerscreen
+        if (row, col) == (innerscreen.height, innerscreen.width):
+            self._pending_size = None
+            return
+        self._pending_size = (row, col)
+        interval = self.resize_interval
+        if interval is not None:
+            if time.time() - self._last_resize >= interval:
+                self._apply_resize()
+
+    def _apply_resize(self):
+        size = self._pending_size
+        if size:
+            row, col = size
+            self._pending_size = None
+            self.innerscreen.resize(row, col)
+            self._tty.resize(row, col)
+            self._last_resize = time.time()
+
+
 class InnerFrame(tff.DefaultHandler,
                  IInnerFrame,
                  IMouseListenerImpl,
-                 IFocusListenerImpl): # aggregate mouse and focus listener
+                 IFocusListenerImpl, # aggregate mouse and focus listener
+                 SupportsCoalescedResizeTrait):
     def __init__(self, session, listener, outerscreen,
                  top, left, row, col,
                  command, termenc, termprop):
@@ -691,6 +740,7 @@ class InnerFrame(tff.DefaultHandler,
         outerscreen = self._outerscreen
         left = self.left + self.offset_left
         top = self.top + self.offset_top
+        frameheight, framewidth = self._getframesize()
 
         if top < 1:
             return;
@@ -700,8 +750,9 @@ class InnerFrame(tff.DefaultHandler,
         innertitle = innerscreen.gettitle()
         if innertitle:
             self._title = innertitle
-        title_length = termprop.wcswidth(self._title)
-        width = innerscreen.width + self._padding_left + self._padding_right
+        wcwidth = get_wcwidth(termprop.wcwidth)
+        title_length = get_wcswidth(termprop.wcwidth)(self._title)
+        width = framewidth + self._padding_left + self._padding_right
         if title_length < width - 11:
             pad_left = (width - title_length) / 2
             pad_right = width - title_length - pad_left
@@ -717,22 +768,22 @@ class InnerFrame(tff.DefaultHandler,
         if not dirtyrange:
             return
 
-        dirty_left = min(dirtyrange)
+        dirty_left = dirtyrange[0][0]
         if dirty_left < left - 1:
             dirty_left = left - 1
         if dirty_left < 0:
             dirty_left = 0
 
-        dirty_right = max(dirtyrange) + 1
-        if dirty_right > left + innerscreen.width + 1:
-            dirty_right = left + innerscreen.width + 1
+        dirty_right = dirtyrange[-1][1]
+        if dirty_right > left + framewidth + 1:
+            dirty_right = left + framewidth + 1
         if dirty_right > outerscreen.width:
             dirty_right = outerscreen.width
 
         n = left - 1
 
         for c in title:
-            length = termprop.wcwidth(ord(c))
+            length = wcwidth(ord(c))
             if n >= outerscreen.width:
                 break
             if n >= dirty_right:
@@ -740,7 +791,7 @@ class InnerFrame(tff.DefaultHandler,
             if n == dirty_left and top > 0:
                 self.moveto(top, n + 1)
             if n >= dirty_left:
-                if n in dirtyrange:
+                if _contains(dirtyrange, n):
                     if n == left + width - 4 and self._hovertype == _HOVERTYPE_BUTTON_CLOSE:
                         window.write('\x1b[37m')
                     window.write(c)
@@ -755,24 +806,25 @@ class InnerFrame(tff.DefaultHandler,
         outerscreen = self._outerscreen
         left = self.left + self.offset_left
         top = self.top + self.offset_top
+        frameheight, framewidth = self._getframesize()
 
         # draw the bottom of frame
-        bottom = top + innerscreen.height - 1 + self._padding_bottom
+        bottom = top + frameheight - 1 + self._padding_bottom
         if bottom < outerscreen.height:
-            if top + innerscreen.height >= 0:
+            if top + frameheight >= 0:
 
                 dirtyrange = dirtyregion[bottom]
 
                 if dirtyrange:
-                    dirty_left = min(dirtyrange)
+                    dirty_left = dirtyrange[0][0]
                     if dirty_left < left - 1:
                         dirty_left = left - 1
                     if dirty_left < 0:
                         dirty_left = 0
 
-                    dirty_right = max(dirtyrange) + 1
-                    if dirty_right > left + innerscreen.width + 1:
-                        dirty_right = left + innerscreen.width + 1
+                    dirty_right = dirtyrange[-1][1]
+                    if dirty_right > left + framewidth + 1:
+                        dirty_right = left + framewidth + 1
                     if dirty_right > outerscreen.width:
                         dirty_right = outerscreen.width
 
@@ -817,7 +869,7 @@ class InnerFrame(tff.DefaultHandler,
                     #    window.write('\x1b[0m')
                     while True:
                         if n >= dirty_right - 1:
-                            if n == left + innerscreen.width:
+                            if n == left + framewidth:
                                 if self._bottom_left_corner == self._bottom_left_corner2:
                                     if self._dragtype == _DRAGTYPE_BOTTOMRIGHT:
                                         window.write('\x1b[0;41m')
@@ -870,32 +922,17 @@ class InnerFrame(tff.DefaultHandler,
         outerscreen = self._outerscreen
         left = self.left + self.offset_left
         top = self.top + self.offset_top
+        frameheight, framewidth = self._getframesize()
 
 
-        for index in xrange(0, innerscreen.height):
+        for index in xrange(0, frameheight):
             if top + index < outerscreen.height:
                 if top + index >= 0:
                     dirtyrange = dirtyregion[top + index]
                     if dirtyrange:
 
-                        dirty_left = min(dirtyrange)
-                        if dirty_left < 0:
-                            dirty_left = 0
-                        if dirty_left < left:
-                            dirty_left = left
-
-                        dirty_right = max(dirtyrange)
-                        if dirty_right > outerscreen.width:
-                            dirty_right = outerscreen.width
-                        if dirty_right > left + innerscreen.width + 1:
-                            dirty_right = left + innerscreen.width + 1
-
-                        dirty_width = dirty_right - dirty_left
-                        if dirty_width < 0:
-                            continue
-
                         # draw the left edge of frame
-                        if left > 0 and left >= dirty_left and left - 1 < outerscreen.width:
+                        if left > 0 and left - 1 < outerscreen.width and _contains(dirtyrange, left - 1):
                             row = top + index
                             col = left - 1
                             self.moveto(row + 1, col + 1)
@@ -919,8 +956,8 @@ class InnerFrame(tff.DefaultHandler,
                                 window.write('\x1b[0m')
 
                         # draw the right edge of frame
-                        col = left + innerscreen.width
-                        if col <= dirty_right and col < outerscreen.width:
+                        col = left + framewidth
+                        if col < outerscreen.width and _contains(dirtyrange, col):
                             row = top + index
                             self.moveto(row + 1, col + 1)
 
@@ -948,29 +985,36 @@ class InnerFrame(tff.DefaultHandler,
         outerscreen = self._outerscreen
         left = self.left + self.offset_left
         top = self.top + self.offset_top
+        frameheight, framewidth = self._getframesize()
 
         #innerscreen.copyrect(window, 0, 0, innerscreen.width, innerscreen.height, left, top, lazy=True)
         # draw the inner content of frame
-        for index in xrange(0, innerscreen.height):
+        for index in xrange(0, frameheight):
             if top + index < outerscreen.height:
                 if top + index >= 0:
-                    dirtyrange = dirtyregion[top + index]
-                    if dirtyrange:
-
-                        dirty_left = min(dirtyrange)
-                        if dirty_left < 0:
-                            dirty_left = 0
+                    if index < innerscreen.height:
+                        content_right = left + innerscreen.width
+                    else:
+                        content_right = left
+                    for dirty_left, dirty_right in dirtyregion[top + index]:
                         if dirty_left < left:
                             dirty_left = left
-
-                        dirty_right = max(dirtyrange)
                         if dirty_right > outerscreen.width:
                             dirty_right = outerscreen.width
-                        if dirty_right > left + innerscreen.width + 1:
-                            dirty_right = left + innerscreen.width + 1
+                        if dirty_right > left + framewidth:
+                            dirty_right = left + framewidth
+
+                        # the frame is larger than the content while a
+                        # resize is pending, fill the rest with blanks
+                        if dirty_right > content_right:
+                            blank_left = max(dirty_left, content_right)
+                            if blank_left < dirty_right:
+                                self.moveto(top + index + 1, blank_left + 1)
+                                window.write('\x1b[0m' + ' ' * (dirty_right - blank_left))
+                            dirty_right = content_right
 
                         dirty_width = dirty_right - dirty_left
-                        if dirty_width < 0:
+                        if dirty_width <= 0:
                             continue
 
                         innerscreen.copyrect(window,
@@ -1032,8 +1076,7 @@ class InnerFrame(tff.DefaultHandler,
 
             left = self.left + self.offset_left
             top = self.top + self.offset_top
-            width = innerscreen.width
-            height = innerscreen.height
+            height, width = self._getframesize()
 
             dirtyregion = region.sub(left - self._padding_left,
                                      top - self._padding_top,
@@ -1050,8 +1093,7 @@ class InnerFrame(tff.DefaultHandler,
 
             left = self.left + self.offset_left
             top = self.top + self.offset_top
-            width = innerscreen.width
-            height = innerscreen.height
+            height, width = self._getframesize()
 
             dirtyregion = region.add(left - self._padding_left,
                                      top - self._padding_top,
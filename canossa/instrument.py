@@ -0,0 +1,298 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+import time
+from itertools import izip
+
+_C0_NAMES = ['NUL', 'SOH', 'STX', 'ETX', 'EOT', 'ENQ', 'ACK', 'BEL',
+             'BS', 'HT', 'LF', 'VT', 'FF', 'CR', 'SO', 'SI',
+             'DLE', 'DC1', 'DC2', 'DC3', 'DC4', 'NAK', 'SYN', 'ETB',
+             'CAN', 'EM', 'SUB', 'ESC', 'FS', 'GS', 'RS', 'US']
+
+_STRING_NAMES = {0x50: 'DCS', 0x58: 'SOS', 0x5d: 'OSC', 0x5e: 'PM', 0x5f: 'APC'}
+
+_PROFILED = ('dispatch_csi', 'dispatch_esc', 'handle_char', 'handle_chars',
+             'handle_control_string', 'handle_draw')
+
+
+def _char_key(c):
+    """
+    >>> _char_key(0x0a)
+    'LF'
+    >>> _char_key(0x7f)
+    'DEL'
+    >>> _char_key(0x41)
+    'char'
+    """
+    if c < 0x20:
+        return _C0_NAMES[c]
+    elif c == 0x7f:
+        return 'DEL'
+    return 'char'
+
+
+def _csi_key(parameter, intermediate, final):
+    """
+    >>> _csi_key([0x31, 0x3b, 0x32], [], 0x48)
+    'CSI H'
+    >>> _csi_key([0x3f, 0x32, 0x35], [], 0x68)
+    'CSI ? h'
+    >>> _csi_key([], [0x20], 0x71)
+    'CSI SP q'
+    """
+    chars = []
+    if parameter and parameter[0] > 0x3b:
+        chars.append(chr(parameter[0]))
+    for c in intermediate:
+        if c == 0x20:
+            chars.append('SP')
+        else:
+            chars.append(chr(c))
+    chars.append(chr(final))
+    return 'CSI ' + ' '.join(chars)
+
+
+def _esc_key(intermediate, final):
+    """
+    >>> _esc_key([0x28], 0x42)
+    'ESC ( B'
+    """
+    return 'ESC ' + ' '.join([chr(c) for c in intermediate + [final]])
+
+
+def _count_cells(line, before):
+    """
+    returns the number of cells of line that differ from before, a
+    (chars, attrs) copy of it
+
+    >>> from line import Line
+    >>> from attribute import Attribute
+    >>> line = Line(5)
+    >>> before = (line._chars[:], line._attrs[:])
+    >>> line.write(0x41, 1, Attribute())
+    >>> line.write(0x42, 3, Attribute())
+    >>> _count_cells(line, before)
+    2
+    >>> _count_cells(line, None)
+    5
+    """
+    chars = line._chars
+    attrs = line._attrs
+    if before is None:
+        return len(chars)
+    oldchars, oldattrs = before
+    if chars == oldchars and attrs == oldattrs:
+        return 0
+    if len(chars) != len(oldchars):
+        return max(len(chars), len(oldchars))
+    ncells = 0
+    for c1, c2, a1, a2 in izip(chars, oldchars, attrs, oldattrs):
+        if c1 != c2 or a1 != a2:
+            ncells += 1
+    return ncells
+
+
+class SupportsProfilingTrait():
+    ''' Opt-in counters of calls, wall time and damage per sequence.
+
+    While disabled, no instance attribute shadows the dispatch methods, so
+    the class-level fast path runs untouched.  Damage is found from the
+    dirty flags of the lines: only the lines a call marks dirty are
+    compared with the copy kept since they last changed, so a scroll
+    counts the line it clears rather than the whole screen.
+    '''
+
+    _profile = None
+    _profile_rows = None
+
+    def enable_profiling(self):
+        '''
+        >>> import StringIO
+        >>> from stub import tff
+        >>> from screen import MockScreenWithCursor
+        >>> from output import Canossa
+        >>> canossa = Canossa(screen=MockScreenWithCursor(), resized=False)
+        >>> context = tff.ParseContext(output=StringIO.StringIO(),
+        ...                            handler=canossa, buffering=False)
+        >>> parser = tff.DefaultParser()
+        >>> parser.init(context)
+        >>> canossa.enable_profiling()
+        >>> parser.parse('ab\\r\\n\\x1b[31mc\\x1b[m\\x1b[2J\\x1b7')
+        >>> profile = canossa.get_profile()
+        >>> sorted(profile.keys())
+        ['CR', 'CSI J', 'CSI m', 'ESC 7', 'LF', 'char']
+        >>> profile['char']['calls'], profile['char']['cells']
+        (3, 3)
+        >>> profile['CSI J']['lines'], profile['CSI J']['cells']
+        (2, 3)
+        >>> canossa.reset_profile()
+        >>> canossa.get_profile()
+        {}
+        >>> from screen import Screen, DummyTermprop
+        >>> canossa = Canossa(screen=Screen(2, 30, termprop=DummyTermprop()),
+        ...                   resized=False)
+        >>> canossa.enable_profiling()
+        >>> canossa.feed('0123456789abcdefghij\\r\\n\\n')
+        ''
+        >>> profile = canossa.get_profile()
+        >>> profile['char']['calls'], profile['char']['cells']
+        (20, 20)
+        >>> profile['LF']['calls'], profile['LF']['lines'], profile['LF']['cells']
+        (2, 1, 20)
+        >>> canossa.reset_profile()
+        >>> canossa.disable_profiling()
+        >>> canossa.is_profiling()
+        False
+        >>> parser.parse('abc')
+        >>> canossa.get_profile()
+        {}
+        '''
+        if self._profile is None:
+            self._profile = {}
+        self._profile_rows = {}
+        for line in self.screen.lines:
+            self._profile_rows[line] = (line._chars[:], line._attrs[:])
+        self.dispatch_csi = self._profiled_dispatch_csi
+        self.dispatch_esc = self._profiled_dispatch_esc
+        self.handle_char = self._profiled_handle_char
+        self.handle_chars = self._profiled_handle_chars
+        self.handle_control_string = self._profiled_handle_control_string
+        self.handle_draw = self._profiled_handle_draw
+
+    def disable_profiling(self):
+        for name in _PROFILED:
+            self.__dict__.pop(name, None)
+        self._profile_rows = None
+
+    def is_profiling(self):
+        return 'dispatch_csi' in self.__dict__
+
+    def get_profile(self):
+        ''' returns a copy of the counters:
+            key -> {'calls', 'seconds', 'lines', 'cells'}
+        '''
+        profile = self._profile
+        if profile is None:
+            return {}
+        result = {}
+        for key, (calls, seconds, lines, cells) in profile.items():
+            result[key] = {'calls': calls,
+                           'seconds': seconds,
+                           'lines': lines,
+                           'cells': cells}
+        return result
+
+    def reset_profile(self):
+        if self._profile is not None:
+            self._profile.clear()
+
+    def _measure(self, key, f, *args):
+        return self._measure_calls(key, 1, f, *args)
+
+    def _measure_calls(self, key, calls, f, *args):
+        # lines already waiting for a redraw are marked clean during the
+        # call, so the dirty flags show what the call itself touched
+        lines = self.screen.lines[:]
+        pending = [line for line in lines if line.dirty]
+        for line in pending:
+            line.dirty = False
+        start = time.time()
+        try:
+            return f(*args)
+        finally:
+            elapsed = time.time() - start
+            nlines = ncells = 0
+            rows = self._profile_rows
+            for line in self.screen.lines[:]:
+                if line.dirty:
+                    n = _count_cells(line, rows.get(line))
+                    if n:
+                        nlines += 1
+                        ncells += n
+                        rows[line] = (line._chars[:], line._attrs[:])
+            for line in pending:
+                line.dirty = True
+            if len(rows) > len(lines) * 2:
+                for line in rows.keys():
+                    if not line in lines:
+                        del rows[line]
+            profile = self._profile
+            value = profile.get(key)
+            if value is None:
+                profile[key] = [calls, elapsed, nlines, ncells]
+            else:
+                value[0] += calls
+                value[1] += elapsed
+                value[2] += nlines
+                value[3] += ncells
+
+    def _profiled_dispatch_csi(self, context, parameter, intermediate, final):
+        key = _csi_key(parameter, intermediate, final)
+        f = self.__class__.dispatch_csi
+        return self._measure(key, f, self, context, parameter, intermediate, final)
+
+    def _profiled_dispatch_esc(self, context, intermediate, final):
+        key = _esc_key(intermediate, final)
+        f = self.__class__.dispatch_esc
+        return self._measure(key, f, self, context, intermediate, final)
+
+    def _profiled_handle_char(self, context, c):
+        f = self.__class__.handle_char
+        return self._measure(_char_key(c), f, self, context, c)
+
+    def _profiled_handle_chars(self, context, run):
+        f = self.__class__.handle_chars
+        return self._measure_calls('char', len(run), f, self, context, run)
+
+    def _profiled_handle_control_string(self, context, prefix, value):
+        key = _STRING_NAMES.get(prefix, 'string')
+        f = self.__class__.handle_control_string
+        return self._measure(key, f, self, context, prefix, value)
+
+    def _profiled_handle_draw(self, context):
+        # drawing clears the dirty flags and changes no cell, so only the
+        # time is counted
+        f = self.__class__.handle_draw
+        start = time.time()
+        try:
+            return f(self, context)
+        finally:
+            elapsed = time.time() - start
+            value = self._profile.get('draw')
+            if value is None:
+                self._profile['draw'] = [1, elapsed, 0, 0]
+            else:
+                value[0] += 1
+                value[1] += elapsed
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    test()
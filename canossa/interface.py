@@ -58,6 +58,9 @@ class IScreen:
     def write(self, c):
         raise NotImplementedError("IScreen::write")
 
+    def write_run(self, run):
+        raise NotImplementedError("IScreen::write_run")
+
     def setlistener(self, listener):
         raise NotImplementedError("IScreen::setlistener")
 
@@ -23,15 +23,36 @@
 # DEALINGS IN THE SOFTWARE.
 # ***** END LICENSE BLOCK *****
 
-from cell import Cell
+import sys
+import struct
+from array import array
+from itertools import groupby
+from bisect import bisect_right
+from attribute import Attribute, get_sgr
 
 _LINE_TYPE_DHLT = 3
 _LINE_TYPE_DHLB = 4
 _LINE_TYPE_SWL  = 5
 _LINE_TYPE_DWL  = 6
 
+_CHAR_PAD = 0x00
+_CHAR_BLANK = 0x20
+_PAD_ARRAY = array('i', [_CHAR_PAD])
+
+if sys.byteorder == 'little':
+    _UTF32 = 'utf-32-le'
+else:
+    _UTF32 = 'utf-32-be'
+
+# a narrow build keeps a character beyond the BMP as two code units
+_NARROW = sys.maxunicode == 0xffff
+
+_HEADER = struct.Struct('<BHHH') # type, width, attribute runs, combinings
+_COMBINE = struct.Struct('<HH')  # position, length of utf-8 bytes
+_WRAPPED = 0x80  # set in the type byte of an encoded line that soft-wraps
+
 '''
-    This module exports Line object, that consists of some cell objects.
+    This module exports Line object, that consists of some cells.
 
        +-----+-----+-----+-...                   ...-+-----+
        |  A  |  B  |  C  |       ... ... ...         |     |
@@ -46,8 +67,45 @@ _LINE_TYPE_DWL  = 6
        +----+---------+-----+-...                   ...-+-----+
         <------------> <--->
          a wide char   char
+
+    The cells are not objects. A line keeps them in parallel arrays:
+
+       _chars   array('i')  code point of each cell (0 for padding)
+       _attrs   array('l')  attribute word of each cell
+       _combine dict        position -> combining characters (or None)
 '''
 
+
+def _unichr(c):
+    if c < 0x10000:
+        return unichr(c)
+    c -= 0x10000
+    c1 = (c >> 10) + 0xd800
+    c2 = (c & 0x3ff) + 0xdc00
+    return unichr(c1) + unichr(c2)
+
+
+def _cell_text(chars):
+    '''
+    Decodes chars with one item per cell: a unicode string, or a list of
+    per-cell strings on a narrow build when some character is beyond the
+    BMP.
+
+    >>> import line
+    >>> chars = array('i', [0x41, 0x1f600, 0, 0x42])
+    >>> _cell_text(chars) == u'A\\U0001f600\\x00B'
+    True
+    >>> line._NARROW, narrow = True, line._NARROW
+    >>> cells = _cell_text(chars)
+    >>> len(cells), cells[0], cells[2], cells[3]
+    (4, u'A', u'\\x00', u'B')
+    >>> line._NARROW = narrow
+    '''
+    if _NARROW and chars and max(chars) > 0xffff:
+        return [_unichr(c) for c in chars]
+    return chars.tostring().decode(_UTF32)
+
+
 class SupportsDoubleSizedTrait():
     ''' For DECDWL/DECDHL support
     '''
@@ -109,8 +167,19 @@ class SupportsWideTrait():
     ''' provides pad method. it makes the cell at specified position contain '\0'. '''
 
     def pad(self, pos):
-        cell = self.cells[pos]
-        cell.pad()
+        '''
+        >>> line = Line(5)
+        >>> line.pad(2)
+        >>> line.get(2) is None
+        True
+        '''
+        if self._shared:
+            self._unshare()
+        self._chars[pos] = _CHAR_PAD
+        combine = self._combine
+        if combine and pos in combine:
+            del combine[pos]
+        self.dirty = True
 
 class SupportsCombiningTrait():
     ''' provides combine method. it combines specified character to the cell at specified position. '''
@@ -123,26 +192,79 @@ class SupportsCombiningTrait():
         >>> line.clear(attr._attrvalue)
         >>> line.write(0x40, 1, attr)
         >>> line.combine(0x300, 2)
+        >>> line.get(1)
+        u'@\\u0300'
+        >>> line.combine(0x308, 2)
+        >>> line.get(1)
+        u'@\\u0300\\u0308'
         '''
+        if self._shared:
+            self._unshare()
+        pos = max(0, pos - 1)
+        combine = self._combine
+        if combine is None:
+            self._combine = {pos: unichr(value)}
+        elif pos in combine:
+            combine[pos] += unichr(value)
+        else:
+            combine[pos] = unichr(value)
+        self.dirty = True
+
+class SupportsCopyOnWriteTrait():
+    ''' provides freeze method. the cell arrays are shared with the frozen
+        line until either side is modified, which copies them first. '''
+
+    _shared = False
+
+    def freeze(self):
         '''
-        >>> print line
-        <ESC>[0m<SP>@̀<SP><SP><SP>
+        >>> from attribute import Attribute
+        >>> line = Line(3)
+        >>> line.write(0x41, 0, Attribute())
+        >>> frozen = line.freeze()
+        >>> frozen._chars is line._chars
+        True
+        >>> line.write(0x42, 0, Attribute())
+        >>> frozen.gettext(), line.gettext()
+        (u'A  ', u'B  ')
+        >>> frozen._chars is line._chars
+        False
         '''
-        self.cells[max(0, pos - 1)].combine(value)
+        line = Line(0)
+        line._chars = self._chars
+        line._attrs = self._attrs
+        line._combine = self._combine
+        line._type = self._type
+        line._wrapped = self._wrapped
+        line._shared = True
+        self._shared = True
+        return line
+
+    def _unshare(self):
+        self._chars = self._chars[:]
+        self._attrs = self._attrs[:]
+        if self._combine:
+            self._combine = dict(self._combine)
+        self._shared = False
 
 class Line(SupportsDoubleSizedTrait,
            SupportsWideTrait,
-           SupportsCombiningTrait):
+           SupportsCombiningTrait,
+           SupportsCopyOnWriteTrait):
+
+    _combine = None
+    _wrapped = False  # the text continues on the next line (auto wrap)
 
     def __init__(self, width):
         '''
         >>> line = Line(10)
-        >>> len(line.cells)
+        >>> line.length()
         10
         >>> line.dirty
         True
         '''
-        self.cells = [Cell() for cell in xrange(0, width)]
+        self._chars = array('i', [_CHAR_BLANK]) * width
+        self._attrs = array('l', [Attribute.defaultvalue]) * width
         self.dirty = True
 
     def length(self):
@@ -151,7 +273,22 @@ class Line(SupportsDoubleSizedTrait,
         >>> line.length()
         19
         '''
-        return len(self.cells)
+        return len(self._chars)
+
+    def is_blank(self):
+        '''
+        >>> line = Line(3)
+        >>> line.is_blank()
+        True
+        >>> line.set_dwl()
+        >>> line.is_blank()
+        False
+        '''
+        if self._type != _LINE_TYPE_SWL or self._combine:
+            return False
+        width = len(self._chars)
+        return (self._chars.count(_CHAR_BLANK) == width
+                and self._attrs.count(Attribute.defaultvalue) == width)
 
     def resize(self, col):
         '''
@@ -168,13 +305,40 @@ class Line(SupportsDoubleSizedTrait,
         >>> line.length()
         20
         '''
-        width = len(self.cells)
+        if self._shared:
+            self._unshare()
+        width = len(self._chars)
         if col < width:
-            self.cells = self.cells[:col]
+            del self._chars[col:]
+            del self._attrs[col:]
+            combine = self._combine
+            if combine:
+                for pos in combine.keys():
+                    if pos >= col:
+                        del combine[pos]
         elif col > width:
-            self.cells += [Cell() for cell in xrange(0, col - width)]
+            self._chars.extend(array('i', [_CHAR_BLANK]) * (col - width))
+            self._attrs.extend(array('l', [Attribute.defaultvalue]) * (col - width))
         self.dirty = True
 
+    def get(self, pos):
+        '''
+        >>> line = Line(3)
+        >>> line.get(0)
+        u' '
+        >>> line.write(0x1f600, 1, Attribute())
+        >>> len(line.get(1)) in (1, 2)
+        True
+        '''
+        c = self._chars[pos]
+        if c == _CHAR_PAD:
+            return None
+        result = _unichr(c)
+        combine = self._combine
+        if combine and pos in combine:
+            return result + combine[pos]
+        return result
+
     def clear(self, attrvalue):
         '''
         >>> from attribute import Attribute
@@ -183,11 +347,115 @@ class Line(SupportsDoubleSizedTrait,
         >>> print line
         <ESC>[0m<SP><SP><SP><SP><SP>
         '''
+        self.fill(_CHAR_BLANK, attrvalue)
+        self.set_swl()
+        self._wrapped = False
+
+    def fill(self, c, attrvalue):
+        '''
+        Sets every cell to c with attrvalue, as DECALN does with 'E'.
+
+        >>> from attribute import Attribute
+        >>> line = Line(3)
+        >>> line.combine(0x300, 1)
+        >>> line.fill(0x45, Attribute()._attrvalue)
+        >>> print line
+        <ESC>[0mEEE
+        '''
         if not self.dirty:
             self.dirty = True
-        self.set_swl()
-        for cell in self.cells:
-            cell.clear(attrvalue)
+        width = len(self._chars)
+        self._chars = array('i', [c]) * width
+        self._attrs = array('l', [attrvalue]) * width
+        self._shared = False
+        self._combine = None
+
+    def erase(self, left, right, attrvalue):
+        '''
+        >>> from attribute import Attribute
+        >>> line = Line(5)
+        >>> attr = Attribute()
+        >>> for i in xrange(0, 5): line.write(0x41 + i, i, attr)
+        >>> line.erase(1, 3, attr._attrvalue)
+        >>> print line
+        <ESC>[0mA<SP><SP>DE
+        '''
+        if left >= right:
+            return
+        if self._shared:
+            self._unshare()
+        self.dirty = True
+        self._chars[left:right] = array('i', [_CHAR_BLANK]) * (right - left)
+        self._attrs[left:right] = array('l', [attrvalue]) * (right - left)
+        combine = self._combine
+        if combine:
+            for pos in combine.keys():
+                if left <= pos < right:
+                    del combine[pos]
+
+    def delete(self, pos, n, attrvalue):
+        '''
+        >>> from attribute import Attribute
+        >>> line = Line(5)
+        >>> attr = Attribute()
+        >>> for i in xrange(0, 5): line.write(0x41 + i, i, attr)
+        >>> line.delete(1, 2, attr._attrvalue)
+        >>> print line
+        <ESC>[0mADE<SP><SP>
+        >>> line.delete(2, 100, attr._attrvalue)
+        >>> print line
+        <ESC>[0mAD<SP><SP><SP>
+        '''
+        if self._shared:
+            self._unshare()
+        chars = self._chars
+        attrs = self._attrs
+        width = len(chars)
+        n = min(n, width - pos)
+        if n <= 0:
+            return
+        chars[pos:width - n] = chars[pos + n:]
+        chars[width - n:] = array('i', [_CHAR_BLANK]) * n
+        attrs[pos:width - n] = attrs[pos + n:]
+        attrs[width - n:] = array('l', [attrvalue]) * n
+        combine = self._combine
+        if combine:
+            self._combine = dict((p if p < pos else p - n, value)
+                                 for p, value in combine.items()
+                                 if p < pos or p >= pos + n)
+        self.dirty = True
+
+    def insert(self, pos, n, attrvalue):
+        '''
+        >>> from attribute import Attribute
+        >>> line = Line(5)
+        >>> attr = Attribute()
+        >>> for i in xrange(0, 5): line.write(0x41 + i, i, attr)
+        >>> line.insert(1, 2, attr._attrvalue)
+        >>> print line
+        <ESC>[0mA<SP><SP>BC
+        >>> line.insert(3, 100, attr._attrvalue)
+        >>> print line
+        <ESC>[0mA<SP><SP><SP><SP>
+        '''
+        if self._shared:
+            self._unshare()
+        chars = self._chars
+        attrs = self._attrs
+        width = len(chars)
+        n = min(n, width - pos)
+        if n <= 0:
+            return
+        chars[pos + n:] = chars[pos:width - n]
+        chars[pos:pos + n] = array('i', [_CHAR_BLANK]) * n
+        attrs[pos + n:] = attrs[pos:width - n]
+        attrs[pos:pos + n] = array('l', [attrvalue]) * n
+        combine = self._combine
+        if combine:
+            self._combine = dict((p if p < pos else p + n, value)
+                                 for p, value in combine.items()
+                                 if p < pos or p + n < width)
+        self.dirty = True
 
     def write(self, value, pos, attr):
         '''
@@ -209,7 +477,36 @@ class Line(SupportsDoubleSizedTrait,
         '''
         if not self.dirty:
             self.dirty = True
-        self.cells[pos].write(value, attr)
+        if self._shared:
+            self._unshare()
+        self._chars[pos] = value
+        self._attrs[pos] = attr._attrvalue
+        combine = self._combine
+        if combine and pos in combine:
+            del combine[pos]
+
+    def write_run(self, run, start, end, pos, attrvalue):
+        '''
+        >>> from attribute import Attribute
+        >>> line = Line(5)
+        >>> line.write_run([0x41, 0x42, 0x43, 0x44], 1, 3, 2, Attribute()._attrvalue)
+        >>> print line
+        <ESC>[0m<SP><SP>BC<SP>
+        '''
+        n = end - start
+        if n <= 0:
+            return
+        if not self.dirty:
+            self.dirty = True
+        if self._shared:
+            self._unshare()
+        self._chars[pos:pos + n] = array('i', run[start:end])
+        self._attrs[pos:pos + n] = array('l', [attrvalue]) * n
+        combine = self._combine
+        if combine:
+            for p in combine.keys():
+                if pos <= p < pos + n:
+                    del combine[p]
 
     def drawrange(self, s, left, right, cursor, lazy=False):
         '''
@@ -223,62 +520,202 @@ class Line(SupportsDoubleSizedTrait,
         >>> print result
         <ESC>[0m<SP><SP>
         '''
-        cells = self.cells
+        chars = self._chars
+        attrs = self._attrs
         attr = cursor.attr
         attr.draw(s)
+        current = attr._attrvalue
         c = None
         if left > 0:
-            cell = cells[left - 1]
-            c = cell.get()
-            if c is None:
+            c = chars[left - 1]
+            if c == _CHAR_PAD:
                 if False and lazy:
                     s.write(' ')
                     left += 1
                 else:
                     s.write(u'\x08') # BS
 
-        for cell in cells[left:right]:
-            c = cell.get()
-            if not c is None:
-                if not attr.equals(cell.attr):
-                    cell.attr.draw(s, attr)
-                    attr.copyfrom(cell.attr)
-                s.write(c)
+        for pos in xrange(left, right):
+            c = chars[pos]
+            if c != _CHAR_PAD:
+                value = attrs[pos]
+                if value != current:
+                    s.write(get_sgr(current, value))
+                    current = value
+                s.write(self.get(pos))
 
         if not lazy:
-            if c is None:
-                for cell in cells[right:]:
-                    c = cell.get()
-                    if not c is None:
-                        if not attr.equals(cell.attr):
-                            cell.attr.draw(s, attr)
-                            attr.copyfrom(cell.attr)
-                        s.write(c)
+            if c == _CHAR_PAD:
+                for pos in xrange(right, len(chars)):
+                    c = chars[pos]
+                    if c != _CHAR_PAD:
+                        value = attrs[pos]
+                        if value != current:
+                            s.write(get_sgr(current, value))
+                            current = value
+                        s.write(self.get(pos))
                         break
+        attr.setvalue(current)
 
     def drawall(self, s, cursor):
         self.dirty = False
-        cells = self.cells
+        chars = self._chars
+        attrs = self._attrs
         s.write(u"\x1b#%d" % self._type)
         attr = cursor.attr
         attr.draw(s)
-        c = None
-        for cell in cells:
-            c = cell.get()
-            if not c is None:
-                if not attr.equals(cell.attr):
-                    cell.attr.draw(s, attr)
-                    attr.copyfrom(cell.attr)
-                s.write(c)
-        if c is None:
-            for cell in cells[right:]:
-                c = cell.get()
-                if not c is None:
-                    if not attr.equals(cell.attr):
-                        cell.attr.draw(s, attr)
-                        attr.copyfrom(cell.attr)
-                    s.write(c)
-                    break
+        current = attr._attrvalue
+        for pos in xrange(0, len(chars)):
+            if chars[pos] != _CHAR_PAD:
+                value = attrs[pos]
+                if value != current:
+                    s.write(get_sgr(current, value))
+                    current = value
+                s.write(self.get(pos))
+        attr.setvalue(current)
+
+    def gettext(self, left=0, right=None):
+        '''
+        Returns the text of the cells in [left, right).  A wide character is
+        included when its right cell (which holds the character) is in range.
+
+        >>> from attribute import Attribute
+        >>> line = Line(5)
+        >>> line.write(0x3042, 1, Attribute())
+        >>> line.pad(0)
+        >>> line.write(0x41, 2, Attribute())
+        >>> line.combine(0x300, 3)
+        >>> line.gettext()
+        u'\\u3042A\\u0300  '
+        >>> line.gettext(2, 4)
+        u'A\\u0300 '
+        >>> line.gettext(0, 1)
+        u''
+        '''
+        chars = self._chars
+        width = len(chars)
+        if right is None or right > width:
+            right = width
+        if left < 0:
+            left = 0
+        if left >= right:
+            return u''
+        if left or right != width:
+            chars = chars[left:right]
+        text = _cell_text(chars)
+        combine = self._combine
+        if combine:
+            text = list(text)
+            for pos, value in combine.items():
+                if left <= pos < right:
+                    text[pos - left] += value
+        if text.__class__ is list:
+            text = u''.join(text)
+        return text.replace(u'\x00', u'')
+
+    def getruns(self, left=0, right=None):
+        '''
+        Yields (col, text, attrvalue) for each run of cells in [left, right)
+        sharing an attribute word.  A padding cell belongs to the run of the
+        wide character next to it.
+
+        >>> from attribute import Attribute
+        >>> line = Line(6)
+        >>> attr = Attribute()
+        >>> line.write(0x41, 0, attr)
+        >>> attr.set_sgr([7])
+        >>> line.pad(1)
+        >>> line.write(0x3042, 2, attr)
+        >>> line.write(0x42, 3, attr)
+        >>> [(col, text) for col, text, value in line.getruns()]
+        [(0, u'A'), (1, u'\\u3042B'), (4, u'  ')]
+        '''
+        chars = self._chars
+        attrs = self._attrs
+        width = len(chars)
+        if right is None or right > width:
+            right = width
+        if left < 0:
+            left = 0
+        if left >= right:
+            return
+        if left or right != width:
+            chars = chars[left:right]
+            attrs = attrs[left:right]
+        text = _cell_text(chars)
+        if text.__class__ is list:
+            pads = [pos for pos, c in enumerate(chars) if not c]
+        else:
+            pads = []
+            pos = text.find(u'\x00')
+            while pos != -1:
+                pads.append(pos)
+                pos = text.find(u'\x00', pos + 1)
+        if pads:
+            attrs = attrs[:]
+            last = len(attrs) - 1
+            for pos in pads:
+                if pos < last:
+                    attrs[pos] = attrs[pos + 1]
+        combine = self._combine
+        if combine:
+            text = list(text)
+            for pos, value in combine.items():
+                if left <= pos < right:
+                    text[pos - left] += value
+        col = 0
+        for value, group in groupby(attrs):
+            n = len(list(group))
+            run = u''.join(text[col:col + n]).replace(u'\x00', u'')
+            yield left + col, run, value
+            col += n
+
+    def encode(self):
+        '''
+        Serializes the line into a compact byte string: run-length encoded
+        attributes followed by UTF-8 text, in which padding cells are '\\0'.
+
+        >>> from attribute import Attribute
+        >>> line = Line(6)
+        >>> attr = Attribute()
+        >>> line.write(0x3042, 1, attr)
+        >>> line.pad(0)
+        >>> line.write(0x41, 2, attr)
+        >>> line.combine(0x300, 3)
+        >>> attr.set_sgr([7])
+        >>> line.write(0x1f600, 3, attr)
+        >>> line.set_dwl()
+        >>> data = line.encode()
+        >>> len(data)
+        42
+        >>> copied = decode_line(data)
+        >>> [copied.get(i) for i in xrange(0, 6)] == [line.get(i) for i in xrange(0, 6)]
+        True
+        >>> copied._attrs == line._attrs
+        True
+        >>> copied.type() == _LINE_TYPE_DWL
+        True
+        >>> line._wrapped = True
+        >>> decode_line(line.encode())._wrapped
+        True
+        '''
+        attrs = self._attrs
+        runs = [(len(list(group)), value) for value, group in groupby(attrs)]
+        combine = self._combine or {}
+        linetype = self._type
+        if self._wrapped:
+            linetype |= _WRAPPED
+        header = _HEADER.pack(linetype, len(attrs), len(runs), len(combine))
+        chunks = [header]
+        if runs:
+            chunks.append(struct.pack('<' + 'Hi' * len(runs),
+                                      *[x for run in runs for x in run]))
+        for pos, value in combine.items():
+            value = value.encode('utf-8')
+            chunks.append(_COMBINE.pack(pos, len(value)))
+            chunks.append(value)
+        chunks.append(self._chars.tostring().decode(_UTF32).encode('utf-8'))
+        return ''.join(chunks)
 
     def __str__(self):
         '''
@@ -292,12 +729,282 @@ class Line(SupportsDoubleSizedTrait,
         language, encoding = locale.getdefaultlocale()
         cursor = Cursor()
         s = codecs.getwriter(encoding)(StringIO.StringIO())
-        self.drawrange(s, 0, len(self.cells), cursor)
+        self.drawrange(s, 0, len(self._chars), cursor)
         result = s.getvalue().replace("\x1b", "<ESC>")
         result = result.replace("\x20", "<SP>")
         result = result.replace("\x00", "<NUL>")
         return result
 
+def decode_line(data):
+    ''' restores a Line object from a byte string made by Line.encode '''
+    linetype, width, nruns, ncombine = _HEADER.unpack_from(data)
+    offset = _HEADER.size
+    line = Line(0)
+    line._type = linetype & ~_WRAPPED
+    line._wrapped = bool(linetype & _WRAPPED)
+    if nruns:
+        fmt = '<' + 'Hi' * nruns
+        values = struct.unpack_from(fmt, data, offset)
+        offset += struct.calcsize(fmt)
+        attrs = line._attrs
+        for i in xrange(0, nruns * 2, 2):
+            attrs.extend(array('l', [values[i + 1]]) * values[i])
+    if ncombine:
+        combine = {}
+        for i in xrange(0, ncombine):
+            pos, length = _COMBINE.unpack_from(data, offset)
+            offset += _COMBINE.size
+            combine[pos] = data[offset:offset + length].decode('utf-8')
+            offset += length
+        line._combine = combine
+    text = data[offset:].decode('utf-8').encode(_UTF32)
+    line._chars.fromstring(text)
+    assert len(line._chars) == width
+    return line
+
+
+def _encoded_attrs(data):
+    ''' returns the attribute words of a byte string made by Line.encode '''
+    nruns = _HEADER.unpack_from(data)[2]
+    return struct.unpack_from('<' + 'Hi' * nruns, data, _HEADER.size)[1::2]
+
+
+def _remap_encoded(data, mapping):
+    '''
+    replaces the attribute words of a byte string made by Line.encode
+    with mapping.get(value, value)
+
+    >>> from attribute import Attribute
+    >>> line = Line(3)
+    >>> data = line.encode()
+    >>> value = Attribute.defaultvalue
+    >>> _encoded_attrs(_remap_encoded(data, {value: 5})), _encoded_attrs(data)[0] == value
+    ((5,), True)
+    '''
+    nruns = _HEADER.unpack_from(data)[2]
+    fmt = '<' + 'Hi' * nruns
+    values = list(struct.unpack_from(fmt, data, _HEADER.size))
+    values[1::2] = [mapping.get(value, value) for value in values[1::2]]
+    end = _HEADER.size + struct.calcsize(fmt)
+    return data[:_HEADER.size] + struct.pack(fmt, *values) + data[end:]
+
+
+def reflow(lines, width, row, col):
+    '''
+    Rewraps the soft-wrapped lines to width.  Trailing blanks of each
+    logical line are dropped, and a wide character never straddles two
+    lines.  Returns the new lines and where the cell at (row, col) went.
+
+    >>> from attribute import Attribute
+    >>> lines = [Line(4), Line(4), Line(4)]
+    >>> for i, c in enumerate(u'abcdef'):
+    ...     lines[i / 4].write(ord(c), i % 4, Attribute())
+    >>> lines[0]._wrapped = True
+    >>> lines[2].write(0x78, 0, Attribute())
+    >>> result, row, col = reflow(lines, 3, 1, 1)
+    >>> [line.gettext() for line in result], row, col
+    ([u'abc', u'def', u'x  '], 1, 2)
+    >>> [line._wrapped for line in result]
+    [True, False, False]
+    >>> result, row, col = reflow(result, 8, 2, 0)
+    >>> [line.gettext() for line in result], row, col
+    ([u'abcdef  ', u'x       '], 1, 0)
+    >>> line = Line(4)
+    >>> line.write(0x41, 0, Attribute())
+    >>> line.pad(1)
+    >>> line.write(0x3042, 2, Attribute())
+    >>> line.combine(0x300, 3)
+    >>> result, row, col = reflow([line], 2, 0, 3)
+    >>> [line.gettext() for line in result], row, col
+    ([u'A ', u'\\u3042\\u0300'], 1, 2)
+    '''
+    blank = Attribute.defaultvalue
+    result = []
+    newrow = newcol = 0
+    i = 0
+    n = len(lines)
+    while i < n:
+        line = lines[i]
+        if line._type != _LINE_TYPE_SWL:
+            # double sized lines are not rewrapped, only cut
+            if i == row:
+                newrow, newcol = len(result), col
+            line.resize(width)
+            line._wrapped = False
+            result.append(line)
+            i += 1
+            continue
+
+        # join a logical line
+        chars = array('i')
+        attrs = array('l')
+        combine = {}
+        cursor = None
+        while True:
+            line = lines[i]
+            base = len(chars)
+            if i == row:
+                cursor = base + col
+            chars.extend(line._chars)
+            attrs.extend(line._attrs)
+            if line._combine:
+                for pos, value in line._combine.items():
+                    combine[base + pos] = value
+            i += 1
+            if not line._wrapped or i >= n or lines[i]._type != _LINE_TYPE_SWL:
+                break
+            # a blank left at the right edge by a wide character that did
+            # not fit is not part of the text
+            if (lines[i]._chars[:1] == _PAD_ARRAY and chars[-1] == _CHAR_BLANK
+                    and len(chars) - 1 not in combine and cursor != len(chars) - 1):
+                chars.pop()
+                attrs.pop()
+
+        end = len(chars)
+        while (end > 0 and chars[end - 1] == _CHAR_BLANK
+               and attrs[end - 1] == blank and end - 1 not in combine):
+            end -= 1
+        if cursor is not None and cursor > end:
+            end = min(cursor, len(chars))
+
+        # split it into lines of the new width
+        first = len(result)
+        starts = []
+        start = 0
+        while True:
+            stop = start + width
+            if width > 1 and stop < end and chars[stop - 1] == _CHAR_PAD:
+                stop -= 1
+            segment = min(stop, end)
+            line = Line(0)
+            line._chars = chars[start:segment]
+            line._attrs = attrs[start:segment]
+            if segment - start < width:
+                line._chars.extend(array('i', [_CHAR_BLANK]) * (width - segment + start))
+                line._attrs.extend(array('l', [blank]) * (width - segment + start))
+            if cursor is not None and (start <= cursor < stop or stop >= end):
+                newrow, newcol = len(result), cursor - start
+                cursor = None
+            starts.append(start)
+            result.append(line)
+            if stop >= end:
+                break
+            line._wrapped = True
+            start = stop
+        for pos, value in combine.items():
+            if pos < end:
+                k = bisect_right(starts, pos) - 1
+                line = result[first + k]
+                if line._combine is None:
+                    line._combine = {}
+                line._combine[pos - starts[k]] = value
+
+    return result, newrow, newcol
+
+
+class LineRing():
+    '''
+    A list-like container of lines, addressed through a rotating base offset.
+    Scrolling the whole buffer only moves the base offset, so it costs
+    the same amount of work regardless of the number of lines.
+
+    >>> ring = LineRing([Line(1) for i in xrange(0, 4)])
+    >>> a, b, c, d = ring
+    >>> len(ring)
+    4
+    >>> ring.rotate(0, 4, 1)
+    >>> ring[:] == [b, c, d, a]
+    True
+    >>> ring[-1] is a
+    True
+    >>> ring.rotate(1, 3, -1)
+    >>> ring[:] == [b, d, c, a]
+    True
+    >>> ring.pop() is a
+    True
+    >>> ring.insert(0, a)
+    >>> ring[:] == [a, b, d, c]
+    True
+    >>> ring[4]
+    Traceback (most recent call last):
+    ...
+    IndexError: line index out of range
+    '''
+
+    def __init__(self, lines):
+        self._lines = list(lines)
+        self._base = 0
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __getitem__(self, index):
+        lines = self._lines
+        size = len(lines)
+        if isinstance(index, slice):
+            base = self._base
+            return [lines[(base + i) % size]
+                    for i in xrange(*index.indices(size))]
+        if index >= size or index < -size:
+            raise IndexError("line index out of range")
+        return lines[(self._base + index) % size]
+
+    def __setitem__(self, index, line):
+        lines = self._lines
+        size = len(lines)
+        if index >= size or index < -size:
+            raise IndexError("line index out of range")
+        lines[(self._base + index) % size] = line
+
+    def __iter__(self):
+        lines = self._lines
+        base = self._base
+        for line in lines[base:]:
+            yield line
+        for line in lines[:base]:
+            yield line
+
+    def _linearize(self):
+        base = self._base
+        if base:
+            lines = self._lines
+            self._lines = lines[base:] + lines[:base]
+            self._base = 0
+
+    def pop(self, index=-1):
+        self._linearize()
+        return self._lines.pop(index)
+
+    def insert(self, index, line):
+        self._linearize()
+        self._lines.insert(index, line)
+
+    def append(self, line):
+        self._linearize()
+        self._lines.append(line)
+
+    def rotate(self, top, bottom, n):
+        '''
+        Scroll the lines in [top, bottom) up by n (down if n is negative).
+        The lines pushed out of one edge appear at the other edge.
+        '''
+        size = len(self._lines)
+        if top == 0 and bottom == size:
+            if size:
+                self._base = (self._base + n) % size
+            return
+        region = self[top:bottom]
+        length = len(region)
+        if length == 0:
+            return
+        n %= length
+        region = region[n:] + region[:n]
+        lines = self._lines
+        base = self._base
+        for i, line in enumerate(region):
+            lines[(base + top + i) % size] = line
+
+
 def test():
     """
     >>> from attribute import Attribute
@@ -23,6 +23,7 @@
 # DEALINGS IN THE SOFTWARE.
 # ***** END LICENSE BLOCK *****
 
+from instrument import SupportsProfilingTrait
 from stub import *
 import thread
 import logging
@@ -60,6 +61,73 @@ def _parse_params(params, minimum=0, offset=0, minarg=1):
    return [param for param in _param_generator(params, minimum, offset, minarg)]
 
 
+def _parse_ints(parameter, result):
+    """
+    Appends the raw integer parameters to result. Omitted ones are 0.
+
+    >>> _parse_ints([0x31, 0x3b, 0x3b, 0x34, 0x32], [])
+    [1, 0, 42]
+    >>> _parse_ints([], [])
+    [0]
+    """
+    param = 0
+    for c in parameter:
+        if c < 0x3a:
+            param = param * 10 + c - 0x30
+        elif c < 0x3c:
+            result.append(param)
+            param = 0
+    result.append(param)
+    return result
+
+
+def _parse_sgr(parameter):
+    """
+    Like _parse_ints, but a colon separated group becomes a tuple.
+
+    >>> _parse_sgr([0x31, 0x3b, 0x34, 0x3a, 0x33])
+    [1, (4, 3)]
+    >>> _parse_sgr([ord(c) for c in '38:2::1:2:3;0'])
+    [(38, 2, 0, 1, 2, 3), 0]
+    """
+    result = []
+    group = None
+    param = 0
+    for c in parameter:
+        if c < 0x3a:
+            param = param * 10 + c - 0x30
+        elif c == 0x3a:
+            if group is None:
+                group = [param]
+            else:
+                group.append(param)
+            param = 0
+        elif c == 0x3b:
+            if group is None:
+                result.append(param)
+            else:
+                group.append(param)
+                result.append(tuple(group))
+                group = None
+            param = 0
+    if group is None:
+        result.append(param)
+    else:
+        group.append(param)
+        result.append(tuple(group))
+    return result
+
+
+def _getarg(params, index, minimum=0, offset=0):
+    """ picks up a parameter in the same manner as _param_generator """
+    if index < len(params):
+        param = params[index] + offset
+        if minimum > param:
+            return minimum
+        return param
+    return minimum
+
+
 import re
 import os
 import select
@@ -162,6 +230,29 @@ class CSIHandlerTrait():
 
     def __init__(self):
 
+        # the handlers which take pre-parsed integer parameters,
+        # looked up by the final byte of sequences without any
+        # private marker or intermediate
+        self._csi_fast_map = {
+            ord('m'): self._fast_sgr,
+            ord('H'): self._fast_cup,
+            ord('K'): self._fast_el,
+            ord('J'): self._fast_ed,
+            ord('G'): self._fast_cha,
+            ord('@'): self._fast_ich,
+            ord('A'): self._fast_cuu,
+            ord('B'): self._fast_cud,
+            ord('C'): self._fast_cuf,
+            ord('D'): self._fast_cub,
+            ord('L'): self._fast_il,
+            ord('M'): self._fast_dl,
+            ord('P'): self._fast_dch,
+            ord('X'): self._fast_ech,
+            ord('d'): self._fast_vpa,
+            ord('f'): self._fast_hvp,
+        }
+        self._csi_params = []
+
         self._csi_map = {
             _pack('m'):   self._handle_sgr,
             _pack('H'):   self._handle_cup,
@@ -182,6 +273,7 @@ class CSIHandlerTrait():
             _pack('L'):   self._handle_il,
             _pack('M'):   self._handle_dl,
             _pack('P'):   self._handle_dch,
+            _pack('X'):   self._handle_ech,
             _pack('>c'):  self._handle_da2,
             _pack('d'):   self._handle_vpa,
             _pack('f'):   self._handle_hvp,
@@ -197,6 +289,74 @@ class CSIHandlerTrait():
         }
 
 
+    def _fast_sgr(self, context, params):
+        if len(params) == 1 and params[0] == 0:
+            self.screen.reset_sgr()
+        else:
+            self.screen.sgr(iter(params))
+        return True
+
+    def _fast_cup(self, context, params):
+        self.screen.cup(_getarg(params, 0, offset=-1), _getarg(params, 1, offset=-1))
+        return True
+
+    def _fast_el(self, context, params):
+        self.screen.el(params[0])
+        return True
+
+    def _fast_ed(self, context, params):
+        self.screen.ed(params[0])
+        return True
+
+    def _fast_cha(self, context, params):
+        self.screen.cha(_getarg(params, 0, offset=-1, minimum=1))
+        return True
+
+    def _fast_ich(self, context, params):
+        self.screen.ich(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_cuu(self, context, params):
+        self.screen.cuu(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_cud(self, context, params):
+        self.screen.cud(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_cuf(self, context, params):
+        self.screen.cuf(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_cub(self, context, params):
+        self.screen.cub(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_il(self, context, params):
+        self.screen.il(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_dl(self, context, params):
+        self.screen.dl(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_dch(self, context, params):
+        self.screen.dch(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_ech(self, context, params):
+        self.screen.ech(_getarg(params, 0, minimum=1))
+        return True
+
+    def _fast_vpa(self, context, params):
+        self.screen.vpa(_getarg(params, 0, offset=-1))
+        return True
+
+    def _fast_hvp(self, context, params):
+        self.screen.hvp(_getarg(params, 0, offset=-1), _getarg(params, 1, offset=-1))
+        return True
+
+
     def _handle_sgr(self, context, parameter):
         """
         SGR - Select Graphics Rendition
@@ -205,13 +365,13 @@ class CSIHandlerTrait():
         >>> screen = MockScreenWithCursor()
         >>> parser = _generate_mock_parser(screen)
         >>> parser.parse('\x1b[1;4;45mabc\x1b[mdef')
+        >>> parser.parse('\x1b[4:3;38:2::10:20:30m')
+        >>> print screen.cursor.attr
+        <ESC>[0;4;4:3;38;2;10;20;30m
         """
-        if not parameter:
-            self.screen.reset_sgr()
-        else:
-            params = _param_generator(parameter)
-            self.screen.sgr(params)
-        return True
+        if 0x3a in parameter:
+            return self._fast_sgr(context, _parse_sgr(parameter))
+        return self._fast_sgr(context, _parse_ints(parameter, []))
 
 
     def _handle_cup(self, context, parameter):
@@ -238,9 +398,7 @@ class CSIHandlerTrait():
         (0, 4)
         """
 
-        row, col = _param_generator(parameter, offset=-1, minarg=2)
-        self.screen.cup(row, col)
-        return True
+        return self._fast_cup(context, _parse_ints(parameter, []))
 
 
     def _handle_sm(self, context, parameter):
@@ -349,9 +507,7 @@ class CSIHandlerTrait():
         >>> print screen.lines[0]
         <ESC>[0m<SP><SP><SP><SP><SP><SP><SP><SP><SP><SP>
         """
-        ps = _parse_params(parameter)[0]
-        self.screen.el(ps)
-        return True
+        return self._fast_el(context, _parse_ints(parameter, []))
 
 
     def _handle_ed(self, context, parameter):
@@ -363,9 +519,7 @@ class CSIHandlerTrait():
         >>> parser = _generate_mock_parser(screen)
         >>> parser.parse('\x1b[J')
         """
-        ps = _parse_params(parameter)[0]
-        self.screen.ed(ps)
-        return True
+        return self._fast_ed(context, _parse_ints(parameter, []))
 
 
     def _handle_cha(self, context, parameter):
@@ -379,9 +533,7 @@ class CSIHandlerTrait():
         >>> screen.getyx()
         (0, 6)
         """
-        ps = _parse_params(parameter, offset=-1, minimum=1)[0]
-        self.screen.cha(ps)
-        return True
+        return self._fast_cha(context, _parse_ints(parameter, []))
 
 
     def _handle_ich(self, context, parameter):
@@ -393,9 +545,7 @@ class CSIHandlerTrait():
         >>> parser = _generate_mock_parser(screen)
         >>> parser.parse('\x1b[7@')
         """
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.ich(ps)
-        return True
+        return self._fast_ich(context, _parse_ints(parameter, []))
 
     def _handle_cuu(self, context, parameter):
         """
@@ -417,9 +567,7 @@ class CSIHandlerTrait():
         (0, 9)
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.cuu(ps)
-        return True
+        return self._fast_cuu(context, _parse_ints(parameter, []))
 
 
     def _handle_cud(self, context, parameter):
@@ -443,9 +591,7 @@ class CSIHandlerTrait():
         (23, 9)
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.cud(ps)
-        return True
+        return self._fast_cud(context, _parse_ints(parameter, []))
 
 
     def _handle_cuf(self, context, parameter):
@@ -469,9 +615,7 @@ class CSIHandlerTrait():
         (4, 79)
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.cuf(ps)
-        return True
+        return self._fast_cuf(context, _parse_ints(parameter, []))
 
 
     def _handle_cub(self, context, parameter):
@@ -495,9 +639,7 @@ class CSIHandlerTrait():
         (4, 0)
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.cub(ps)
-        return True
+        return self._fast_cub(context, _parse_ints(parameter, []))
 
 
     def _handle_il(self, context, parameter):
@@ -510,9 +652,7 @@ class CSIHandlerTrait():
         >>> parser.parse('\x1b[7L')
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.il(ps)
-        return True
+        return self._fast_il(context, _parse_ints(parameter, []))
 
 
     def _handle_dl(self, context, parameter):
@@ -525,9 +665,7 @@ class CSIHandlerTrait():
         >>> parser.parse('\x1b[7M')
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.dl(ps)
-        return True
+        return self._fast_dl(context, _parse_ints(parameter, []))
 
 
     def _handle_dch(self, context, parameter):
@@ -540,9 +678,20 @@ class CSIHandlerTrait():
         >>> parser.parse('\x1b[7P')
         """
 
-        ps = _parse_params(parameter, minimum=1)[0]
-        self.screen.dch(ps)
-        return True
+        return self._fast_dch(context, _parse_ints(parameter, []))
+
+
+    def _handle_ech(self, context, parameter):
+        """
+        ECH - Erase Character(s)
+
+        >>> from screen import MockScreenWithCursor
+        >>> screen = MockScreenWithCursor()
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('\x1b[7X')
+        """
+
+        return self._fast_ech(context, _parse_ints(parameter, []))
 
 
     def _handle_da2(self, context, parameter):
@@ -579,9 +728,7 @@ class CSIHandlerTrait():
         (23, 3)
         """
 
-        ps = _parse_params(parameter, offset=-1)[0]
-        self.screen.vpa(ps)
-        return True
+        return self._fast_vpa(context, _parse_ints(parameter, []))
 
 
     def _handle_hvp(self, context, parameter):
@@ -609,9 +756,7 @@ class CSIHandlerTrait():
 
         """
 
-        row, col = _parse_params(parameter, offset=-1, minarg=2)
-        self.screen.hvp(row, col)
-        return True
+        return self._fast_hvp(context, _parse_ints(parameter, []))
 
 
     def _handle_tbc(self, context, parameter):
@@ -772,9 +917,18 @@ class CSIHandlerTrait():
     def dispatch_csi(self, context, parameter, intermediate, final):
         if parameter and parameter[0] > 0x3b:
             key = parameter[0]
+        elif not intermediate:
+            f = self._csi_fast_map.get(final)
+            # sub-parameters (e.g. SGR 4:3) need the full handler
+            if f is not None and not 0x3a in parameter:
+                params = self._csi_params
+                del params[:]
+                return f(context, _parse_ints(parameter, params))
+            key = 0
         else:
             key = 0
-        key = reduce(lambda acc, x: acc << 8 | x, intermediate, key)
+        for c in intermediate:
+            key = key << 8 | c
         key = key << 8 | final
 
         f = self._csi_map[key]
@@ -996,7 +1150,9 @@ class ESCHandlerTrait():
 
 
     def dispatch_esc(self, context, intermediate, final):
-        key = reduce(lambda acc, x: acc << 8 | x, intermediate, 0)
+        key = 0
+        for c in intermediate:
+            key = key << 8 | c
         key = key << 8 | final
 
         #elif intermediate == [0x28]: # (
@@ -1011,9 +1167,162 @@ class ESCHandlerTrait():
         return f()
 
 
+# printable ASCII long enough to be worth bypassing the parser, which
+# starts a chunk or follows a control character, a non-ASCII byte or a
+# complete CSI sequence
+_FEED_MIN_RUN = 16
+_feed_run_pattern = re.compile('(?:(?<=[\x00-\x1a\x1c-\x1f\x80-\xff])|^|'
+                               '\x1b\[[\x30-\x3f]*[\x20-\x2f]*[\x40-\x7e])'
+                               '([\x20-\x7e]{%d,})' % _FEED_MIN_RUN)
+
+
+class _FeedReplies():
+    """ collects what the handler puts back for the application """
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(data)
+
+    def flush(self):
+        pass
+
+
+class _Discard():
+    """ drops sequences the handler passes through, such as OSC 7 """
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        pass
+
+
+class _FeedContext(tff.ParseContext):
+    """
+    Sends replies written with puts() to replies, and what the handler
+    passes through (put(), unhandled sequences) to output.
+    """
+
+    def __init__(self, replies, output, termenc, scanner, handler):
+        tff.ParseContext.__init__(self,
+                                  output=output,
+                                  termenc=termenc,
+                                  scanner=scanner,
+                                  handler=handler,
+                                  buffering=False)
+        self._replies = replies
+
+    def puts(self, data):
+        self._replies.write(data)
+
+
+class SupportsFeedTrait():
+
+    _feed_parser = None
+
+    def feed(self, data):
+        """
+        Parses a chunk of output from the application.  Chunks may split
+        escape sequences and multibyte characters anywhere.  Returns the
+        replies (e.g. CPR) to send back to the application.  Sequences the
+        screen does not handle (e.g. OSC 7) are dropped.
+
+        >>> from screen import Screen
+        >>> import termprop
+        >>> screen = Screen(3, 10, termprop=termprop.MockTermprop())
+        >>> canossa = Canossa(screen=screen, resized=False)
+        >>> for chunk in ('ab\\x1b', '[3', '1mc\\xe3', '\\x81', '\\x82d'):
+        ...     canossa.feed(chunk)
+        ''
+        ''
+        ''
+        ''
+        ''
+        >>> screen.get_lines()
+        [u'abc\\u3042d', u'', u'']
+        >>> canossa.feed('\\r\\n\\x1b[mthe quick brown fox\\x1b[6n')
+        '\\x1b[3;10R'
+        >>> screen.get_lines()
+        [u'abc\\u3042d', u'the quick', u'brown fox']
+        >>> canossa.feed('\\x1b]7;file://host/tmp\\x07')
+        ''
+        """
+        parser = self._feed_parser
+        if parser is None:
+            parser = self._open_feed()
+        pos = 0
+        for match in _feed_run_pattern.finditer(data):
+            start, end = match.span(1)
+            if pos < start:
+                parser.parse(data[pos:start])
+            pos = start
+            # the run may still belong to a sequence or follow an
+            # incomplete multibyte character, then the parser takes it
+            # along with the next piece
+            if parser.state_is_esc() or self._feed_decoder.getstate()[0]:
+                continue
+            self._feed_text(bytearray(data[start:end]))
+            pos = end
+        if pos < len(data):
+            if pos:
+                data = data[pos:]
+            parser.parse(data)
+        chunks = self._feed_replies.chunks
+        if not chunks:
+            return ''
+        replies = ''.join(chunks)
+        del chunks[:]
+        return replies
+
+    def _open_feed(self):
+        termenc = self.screen.termenc
+        scanner = tff.DefaultScanner()
+        scanner.assign('', termenc)
+        self._feed_decoder = scanner._decoder
+        self._feed_replies = _FeedReplies()
+        context = _FeedContext(replies=self._feed_replies,
+                               output=_Discard(),
+                               termenc=termenc,
+                               scanner=scanner,
+                               handler=self)
+        parser = tff.DefaultParser()
+        parser.init(context)
+        self._feed_context = context
+        self._feed_parser = parser
+        return parser
+
+    def _feed_text(self, run):
+        # SP at the right margin overwrites the last column instead of
+        # wrapping (see Screen.sp), so it must not go through write_run
+        screen = self.screen
+        if screen.decawm:
+            width = screen.width
+            start = 0
+            i = width - screen.cursor.col
+            n = len(run)
+            while i < n:
+                if run[i] == 0x20:
+                    if start < i:
+                        self.handle_chars(self._feed_context, run[start:i])
+                    self.handle_char(self._feed_context, 0x20)
+                    start = i + 1
+                    i = start
+                else:
+                    i += width
+            if start:
+                run = run[start:]
+                if not run:
+                    return
+        self.handle_chars(self._feed_context, run)
+
+
 class Canossa(tff.DefaultHandler,
               CSIHandlerTrait,
-              ESCHandlerTrait):
+              ESCHandlerTrait,
+              SupportsFeedTrait,
+              SupportsProfilingTrait):
 
     __cpr = False
     dirty = True
@@ -1173,6 +1482,26 @@ class Canossa(tff.DefaultHandler,
         return True
 
 
+    def handle_chars(self, context, run):
+        """
+        Bulk entry point for a run of printable narrow characters.
+
+        >>> from screen import MockScreenWithCursor
+        >>> screen = MockScreenWithCursor()
+        >>> canossa = Canossa(screen=screen, resized=False)
+        >>> canossa.handle_chars(None, [ord(c) for c in 'abc'])
+        True
+        >>> screen.getyx()
+        (0, 3)
+        """
+        if self._resized:
+            self._resized = False
+            self.screen.adjust_cursor()
+        self.dirty = True
+        self.screen.write_run(run)
+        return True
+
+
     def handle_draw(self, context):
         if self._visibility and self.dirty:
             self.screen.drawall(context)
@@ -29,6 +29,7 @@ import logging
 from interface import IModeListener
 from interface import IListbox, IListboxListener
 from mouse import IFocusListener, IMouseListener
+from widthtable import get_wcwidth, get_wcswidth
 
 _POPUP_DIR_NORMAL = True
 _POPUP_DIR_REVERSE = False
@@ -267,11 +268,11 @@ class IListboxImpl(IListbox):
 
                 if dirtyrange:
 
-                    dirty_left = min(dirtyrange)
+                    dirty_left = dirtyrange[0][0]
                     if dirty_left < 0:
                         dirty_left = 0
 
-                    dirty_right = max(dirtyrange) + 1
+                    dirty_right = dirtyrange[-1][1]
                     if dirty_right > screen.width:
                         dirty_right = screen.width
 
@@ -287,7 +288,7 @@ class IListboxImpl(IListbox):
                     else: # unselected lines
                         window.write(style_unselected)
 
-                    wcwidth = self._termprop.wcwidth
+                    wcwidth = get_wcwidth(self._termprop.wcwidth)
                     n = left
 
                     for c in value:
@@ -335,7 +336,7 @@ class IListboxImpl(IListbox):
         return self._window.is_shown()
 
     def _truncate_str(self, s, length):
-        wcwidth = self._termprop.wcwidth
+        wcwidth = get_wcwidth(self._termprop.wcwidth)
         l = 0
         for i in xrange(0, len(s)):
             if l > length:
@@ -377,8 +378,9 @@ class IListboxImpl(IListbox):
         else:
             pos = self._index
 
+        wcswidth = get_wcswidth(self._termprop.wcwidth)
         for value in candidates:
-            length = self._termprop.wcswidth(value)
+            length = wcswidth(value)
             width = max(width, length)
 
         candidates = [self._truncate_str(s, width) for s in candidates]
@@ -29,17 +29,44 @@ try:
 except ImportError:
     from StringIO import StringIO
 import codecs
+import struct
+from array import array
 
 from interface import IScreen
 from exception import CanossaRangeException
 from constant import *
 
+_SCROLLOPS_MAX = 8
+_LINE_POOL_MAX = 256
+
+# snapshot format: magic, version, geometry, cursor, margins, modes, charsets
+_SNAPSHOT_MAGIC = 'CNSS'
+_SNAPSHOT_VERSION = 2
+_SNAPSHOT_HEADER = struct.Struct('<4sBHHHHiHHHHHB4s')
+_SNAPSHOT_CURSOR = struct.Struct('<HHi')
+_SNAPSHOT_SHORT = struct.Struct('<H')
+_SNAPSHOT_LENGTH = struct.Struct('<I')
+_SNAPSHOT_EXTENDED = struct.Struct('<iiBBiii')
+
+_SNAPSHOT_DECTCEM = 0x01
+_SNAPSHOT_DECAWM = 0x02
+_SNAPSHOT_DECOM = 0x04
+_SNAPSHOT_ALLOW_DECCOLM = 0x08
+_SNAPSHOT_BRACKETED_PASTE = 0x10
+_SNAPSHOT_ALTBUF = 0x20
+_SNAPSHOT_SAVED_CURSOR = 0x40
+_SNAPSHOT_SAVED_POS = 0x80
+
 
 #
 # CSI ... ; ... R
 #
+from attribute import Attribute, _split, _intern, _register_owner
+from attribute import _current_table, _encode_sgr
 from cursor import Cursor
-from line import Line
+from line import Line, LineRing, decode_line, reflow
+from shadow import Shadow
+from widthtable import get_wcwidth
 from mouse import IFocusListener, IMouseListener, MouseDecoder
 
 
@@ -224,11 +251,58 @@ class SuuportsISO2022DesignationTrait():
         self.__gl = self.__g[0]
         self.cursor.attr.set_charset(self.__gl)
 
+    def _get_charset_state(self):
+        return self.__g[:], self.__gl
+
+    def _set_charset_state(self, g, gl):
+        self.__g = list(g)
+        self.__gl = gl
+
+
+class SupportsLinePoolTrait():
+    ''' Keeps lines dropped from the buffers for reuse.
+
+    >>> screen = Screen(4, 5, termprop=DummyTermprop())
+    >>> screen.switch_altbuf()
+    >>> line = screen.lines[3]
+    >>> screen.resize(2, 5)
+    >>> len(screen._line_pool)
+    2
+    >>> screen.resize(4, 5)
+    >>> len(screen._line_pool), line in screen.lines[:]
+    (0, True)
+    >>> screen.resize(2, 8)
+    >>> screen.resize(2, 5)
+    >>> screen._line_pool
+    '''
+
+    _line_pool = None
+
+    def _new_line(self, width):
+        pool = self._line_pool
+        if not pool:
+            return Line(width)
+        line = pool.pop()
+        if line.length() != width:
+            line.resize(width)
+        line.clear(Attribute.defaultvalue)
+        return line
+
+    def _release_line(self, line):
+        pool = self._line_pool
+        if pool is None:
+            pool = self._line_pool = []
+        if len(pool) < _LINE_POOL_MAX:
+            pool.append(line)
+
+    def _reset_line_pool(self):
+        self._line_pool = None
+
 
 class SuuportsAlternateScreenTrait():
 
     def _setup_altbuf(self):
-        self._altbuf = [Line(self.width) for line in xrange(0, self.height)]
+        self._altbuf = LineRing([Line(self.width) for line in xrange(0, self.height)])
         self._mainbuf = self.lines
 
     def switch_mainbuf(self):
@@ -237,14 +311,14 @@ class SuuportsAlternateScreenTrait():
         lines = self.lines
         if len(lines) > self.height:
             while len(lines) != self.height:
-                lines.pop()
+                self._release_line(lines.pop())
             for line in lines:
                 line.resize(self.width)
         elif len(lines) < self.height:
             for line in lines:
                 line.resize(self.width)
             while len(lines) < self.height:
-                lines.insert(0, Line(self.width))
+                lines.insert(0, self._new_line(self.width))
         else:
             for line in lines:
                 line.resize(self.width)
@@ -252,6 +326,8 @@ class SuuportsAlternateScreenTrait():
         for line in lines:
             line.dirty = True
             assert self.width == line.length()
+        del self._scrollops[:]
+        self._shadow = None
         self._region = Region()
 
     def switch_altbuf(self):
@@ -259,20 +335,23 @@ class SuuportsAlternateScreenTrait():
         lines = self.lines
         if len(lines) > self.height:
             while len(lines) > self.height:
-                lines.pop()
+                self._release_line(lines.pop())
             for line in lines:
                 line.resize(self.width)
         elif len(lines) < self.height:
             for line in lines:
                 line.resize(self.width)
             while len(lines) < self.height:
-                lines.insert(0, Line(self.width))
+                lines.insert(0, self._new_line(self.width))
         else:
             for line in lines:
                 line.resize(self.width)
         assert len(lines) == self.height
         for line in lines:
+            line.dirty = True
             assert self.width == line.length()
+        del self._scrollops[:]
+        self._shadow = None
 
 
 class SupportsAnsiModeTrait():
@@ -1030,9 +1109,236 @@ class SupportsTabStopTrait():
         self.cursor.dirty = True
 
 
+class SupportsSnapshotTrait():
+    ''' Serializes the emulation state into a versioned byte string.
+
+    Lines are stored with Line.encode, so attributes are run-length encoded
+    and text is UTF-8.  Windows, the scrollback and the drawing state are
+    not part of a snapshot.
+    '''
+
+    def snapshot(self):
+        '''
+        >>> screen = Screen(3, 10, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('\\x1b[1;31mab\\x1b7\\x1b[2;3r\\x1b[?2004h\\x1b[3g')
+        >>> parser.parse('\\x1b]2;title\\x1b\\\\\\x1b[?1049hc\\x1b[m\\x1b[3;5H')
+        >>> data = screen.snapshot()
+        >>> len(data)
+        237
+        >>> restored = Screen(24, 80, termprop=DummyTermprop())
+        >>> restored.restore(data)
+        >>> restored.height, restored.width, restored.getyx()
+        (3, 10, (2, 4))
+        >>> restored.lines is restored._altbuf
+        True
+        >>> restored.lines[1].gettext()
+        u'c         '
+        >>> restored._mainbuf[0].gettext()
+        u'ab        '
+        >>> restored._mainbuf[0]._attrs == screen._mainbuf[0]._attrs
+        True
+        >>> restored.scroll_top, restored.scroll_bottom, restored._tabstop
+        (1, 3, [])
+        >>> restored.bracketed_paste, restored.gettitle()
+        (True, u'title')
+        >>> restored.switch_mainbuf()
+        >>> restored.cursor.restore()
+        >>> restored.getyx()
+        (0, 2)
+        >>> parser.parse('\x1b[38;2;1;2;3mx')
+        >>> restored.restore(screen.snapshot())
+        >>> print restored.cursor.attr
+        <ESC>[0;38;2;1;2;3m
+        >>> restored.restore('XXXX')
+        Traceback (most recent call last):
+        ...
+        ValueError: not a screen snapshot
+        '''
+        cursor = self.cursor
+        flags = 0
+        if self.dectcem:
+            flags |= _SNAPSHOT_DECTCEM
+        if self.decawm:
+            flags |= _SNAPSHOT_DECAWM
+        if self.decom:
+            flags |= _SNAPSHOT_DECOM
+        if self.allow_deccolm:
+            flags |= _SNAPSHOT_ALLOW_DECCOLM
+        if self.bracketed_paste:
+            flags |= _SNAPSHOT_BRACKETED_PASTE
+        if self.lines is self._altbuf:
+            flags |= _SNAPSHOT_ALTBUF
+        if cursor._backup:
+            flags |= _SNAPSHOT_SAVED_CURSOR
+        if self._saved_pos:
+            flags |= _SNAPSHOT_SAVED_POS
+        g, gl = self._get_charset_state()
+        chunks = [_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, _SNAPSHOT_VERSION,
+                                        self.height, self.width,
+                                        cursor.row, cursor.col,
+                                        cursor.attr._attrvalue,
+                                        self.scroll_top, self.scroll_bottom,
+                                        flags,
+                                        self.mouse_protocol,
+                                        self.mouse_encoding,
+                                        gl, ''.join([chr(c) for c in g]))]
+        if cursor._backup:
+            backup = cursor._backup
+            chunks.append(_SNAPSHOT_CURSOR.pack(backup.row, backup.col,
+                                                backup.attr._attrvalue))
+        if self._saved_pos:
+            row, col = self._saved_pos
+            chunks.append(_SNAPSHOT_CURSOR.pack(row, col, 0))
+        title = self._title.encode('utf-8')
+        chunks.append(_SNAPSHOT_SHORT.pack(len(title)))
+        chunks.append(title)
+        tabstop = self._tabstop
+        chunks.append(_SNAPSHOT_SHORT.pack(len(tabstop)))
+        chunks.append(struct.pack('<%dH' % len(tabstop), *tabstop))
+        extended = set()
+        for lines in (self._mainbuf, self._altbuf):
+            chunks.append(_SNAPSHOT_SHORT.pack(len(lines)))
+            for line in lines:
+                data = line.encode()
+                chunks.append(_SNAPSHOT_LENGTH.pack(len(data)))
+                chunks.append(data)
+                if line._attrs and min(line._attrs) < 0:
+                    extended.update(line._attrs)
+        # words with extended attributes index a per-process table, so
+        # the entries they use travel with the snapshot
+        extended.add(cursor.attr._attrvalue)
+        if cursor._backup:
+            extended.add(cursor._backup.attr._attrvalue)
+        extended = [value for value in extended if value < 0]
+        chunks.append(_SNAPSHOT_SHORT.pack(len(extended)))
+        for value in extended:
+            base, extras = _split(value)
+            chunks.append(_SNAPSHOT_EXTENDED.pack(value, base, *extras))
+        return ''.join(chunks)
+
+    def restore(self, data):
+        ''' replaces the state with the one saved by snapshot() '''
+        if len(data) < _SNAPSHOT_HEADER.size or not data.startswith(_SNAPSHOT_MAGIC):
+            raise ValueError('not a screen snapshot')
+        (magic, version, height, width, row, col, attrvalue,
+         scroll_top, scroll_bottom, flags, mouse_protocol, mouse_encoding,
+         gl, g) = _SNAPSHOT_HEADER.unpack_from(data)
+        if version > _SNAPSHOT_VERSION:
+            raise ValueError('unsupported snapshot version: %d' % version)
+        offset = _SNAPSHOT_HEADER.size
+
+        self.height = height
+        self.width = width
+        self.cursor = Cursor(row, col, Attribute(attrvalue))
+        if flags & _SNAPSHOT_SAVED_CURSOR:
+            row, col, attrvalue = _SNAPSHOT_CURSOR.unpack_from(data, offset)
+            offset += _SNAPSHOT_CURSOR.size
+            self.cursor._backup = Cursor(row, col, Attribute(attrvalue))
+        if flags & _SNAPSHOT_SAVED_POS:
+            row, col, attrvalue = _SNAPSHOT_CURSOR.unpack_from(data, offset)
+            offset += _SNAPSHOT_CURSOR.size
+            self._saved_pos = (row, col)
+        else:
+            self._saved_pos = None
+        self.scroll_top = scroll_top
+        self.scroll_bottom = scroll_bottom
+        self.dectcem = bool(flags & _SNAPSHOT_DECTCEM)
+        self.decawm = bool(flags & _SNAPSHOT_DECAWM)
+        self.decom = bool(flags & _SNAPSHOT_DECOM)
+        self.allow_deccolm = bool(flags & _SNAPSHOT_ALLOW_DECCOLM)
+        self.bracketed_paste = bool(flags & _SNAPSHOT_BRACKETED_PASTE)
+        self.mouse_protocol = mouse_protocol
+        self.mouse_encoding = mouse_encoding
+        self._set_charset_state([ord(c) for c in g], gl)
+
+        length, = _SNAPSHOT_SHORT.unpack_from(data, offset)
+        offset += _SNAPSHOT_SHORT.size
+        self._title = data[offset:offset + length].decode('utf-8')
+        offset += length
+        length, = _SNAPSHOT_SHORT.unpack_from(data, offset)
+        offset += _SNAPSHOT_SHORT.size
+        self._tabstop = list(struct.unpack_from('<%dH' % length, data, offset))
+        offset += length * 2
+
+        buffers = []
+        for i in xrange(2):
+            count, = _SNAPSHOT_SHORT.unpack_from(data, offset)
+            offset += _SNAPSHOT_SHORT.size
+            lines = []
+            for j in xrange(count):
+                length, = _SNAPSHOT_LENGTH.unpack_from(data, offset)
+                offset += _SNAPSHOT_LENGTH.size
+                lines.append(decode_line(data[offset:offset + length]))
+                offset += length
+            buffers.append(LineRing(lines))
+        self._mainbuf, self._altbuf = buffers
+        if version >= 2:
+            count, = _SNAPSHOT_SHORT.unpack_from(data, offset)
+            offset += _SNAPSHOT_SHORT.size
+            mapping = {}
+            for i in xrange(count):
+                entry = _SNAPSHOT_EXTENDED.unpack_from(data, offset)
+                offset += _SNAPSHOT_EXTENDED.size
+                # the buffers still hold the words of the snapshot, so
+                # the table must not be reclaimed here
+                value = _intern(entry[1], entry[2:], reclaim=False)
+                if value != entry[0]:
+                    mapping[entry[0]] = value
+            if mapping:
+                self._remap_attrs(mapping)
+        if flags & _SNAPSHOT_ALTBUF:
+            self.lines = self._altbuf
+        else:
+            self.lines = self._mainbuf
+        for line in self.lines:
+            line.dirty = True
+        self._scrollops = []
+        self._shadow = None
+        self._region = Region()
+
+
+    def _collect_attrs(self, used):
+        for lines in (self._mainbuf, self._altbuf):
+            _collect_line_attrs(lines, used)
+        for cursor in (self.cursor, self.cursor._backup):
+            if cursor:
+                used.add(cursor.attr._attrvalue)
+        if self.scrollback is not None:
+            self.scrollback._collect_attrs(used)
+
+    def _remap_attrs(self, mapping):
+        for lines in (self._mainbuf, self._altbuf):
+            _remap_line_attrs(lines, mapping)
+        for cursor in (self.cursor, self.cursor._backup):
+            if cursor:
+                value = cursor.attr._attrvalue
+                cursor.attr.setvalue(mapping.get(value, value))
+        if self.scrollback is not None:
+            self.scrollback._remap_attrs(mapping)
+        # the terminal keeps the old words
+        self._shadow = None
+
+
+def _collect_line_attrs(lines, used):
+    for line in lines:
+        attrs = line._attrs
+        if attrs and min(attrs) < 0:
+            used.update(attrs)
+
+
+def _remap_line_attrs(lines, mapping):
+    get = mapping.get
+    for line in lines:
+        attrs = line._attrs
+        if attrs and min(attrs) < 0:
+            line._attrs = array('l', [get(value, value) for value in attrs])
+
+
 class IScreenImpl(IScreen):
 
     _listener = None
+    _shadow = None
 
     def copyline(self, s, x, y, length, lazy=False):
         if not lazy:
@@ -1121,14 +1427,101 @@ class IScreenImpl(IScreen):
         cursor = self.cursor
         return cursor.row, cursor.col
 
+    def _record_scroll(self, top, bottom, n):
+        """
+        Remembers that the region [top, bottom) has been scrolled up by n
+        lines (down if n is negative), so that the next drawall can replay
+        it as a hardware scroll instead of repainting the moved lines.
+
+        >>> from screen import MockScreenWithCursor
+        >>> screen = MockScreenWithCursor(5, 4)
+        >>> for line in screen.lines: line.dirty = False
+        >>> screen._record_scroll(0, 5, 1)
+        >>> screen._record_scroll(0, 5, 2)
+        >>> screen._record_scroll(1, 3, -1)
+        >>> screen._scrollops
+        [(0, 5, 3), (1, 3, -1)]
+        >>> screen._record_scroll(1, 3, -1)
+        >>> screen._scrollops
+        [(0, 5, 3)]
+        >>> [line.dirty for line in screen.lines]
+        [False, True, True, False, False]
+        """
+        ops = self._scrollops
+        if ops:
+            last_top, last_bottom, last_n = ops[-1]
+            if last_top == top and last_bottom == bottom:
+                ops.pop()
+                n += last_n
+                if n == 0:
+                    return
+        if abs(n) >= bottom - top:
+            for line in self.lines[top:bottom]:
+                line.dirty = True
+        elif len(ops) >= _SCROLLOPS_MAX:
+            for line in self.lines:
+                line.dirty = True
+            del ops[:]
+        else:
+            ops.append((top, bottom, n))
+
+    def _drawscroll(self, s, shadow):
+        """
+        >>> import StringIO
+        >>> from screen import MockScreenWithCursor
+        >>> screen = MockScreenWithCursor(3, 4)
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('a\\r\\nb\\r\\nc\\r\\nd')
+        >>> screen._scrollops
+        [(0, 3, 1)]
+        >>> [line.dirty for line in screen.lines]
+        [True, True, True]
+        >>> s = StringIO.StringIO()
+        >>> screen._drawscroll(s, Shadow(3, 4))
+        >>> print s.getvalue().replace('\\x1b', '<ESC>')
+        <ESC>[1;3r<ESC>[1S<ESC>[r
+        >>> screen._scrollops
+        []
+        """
+        ops = self._scrollops
+        if ops:
+            for top, bottom, n in ops:
+                s.write("\x1b[%d;%dr" % (top + 1, bottom))
+                if n > 0:
+                    s.write("\x1b[%dS" % n)
+                else:
+                    s.write("\x1b[%dT" % -n)
+                shadow.scroll(top, bottom, n)
+            s.write("\x1b[r")
+            del ops[:]
+
     def drawall(self, context):
+        """
+        Emits the changes since the last call, or the whole screen if the
+        contents of the terminal is unknown.
+
+        >>> class Context():
+        ...     def puts(self, s):
+        ...         print s.replace('\\x1b', '<ESC>').replace(' ', '<SP>')
+        >>> screen = Screen(2, 4, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('abc')
+        >>> screen.drawall(Context())
+        <ESC>[0m<ESC>[1H<ESC>#5abc<SP><ESC>[2H<ESC>#5<SP><SP><SP><SP><ESC>[1;4H<ESC>[0m
+        >>> parser.parse('\\x1b[1;2HX')
+        >>> screen.drawall(Context())
+        <ESC>[0m<ESC>[1;2HX<ESC>[1;3H<ESC>[0m
+        """
         s = self._output
-        cursor = Cursor(0, 0)
-        cursor.attr.draw(s)
-        for i in xrange(0, self.height):
-            s.write("\x1b[%d;1H" % (i + 1))
-            line = self.lines[i]
-            line.drawall(s, cursor)
+        attr = Attribute()
+        attr.draw(s)
+        shadow = self._shadow
+        if shadow is None or shadow.height != self.height or shadow.width != self.width:
+            shadow = self._shadow = Shadow(self.height, self.width)
+            del self._scrollops[:]
+        else:
+            self._drawscroll(s, shadow)
+        shadow.draw(s, self.lines, attr)
         self.cursor.draw(s)
         self.cursor.attr.draw(s)
         context.puts(s.getvalue())
@@ -1192,26 +1585,68 @@ class IScreenImpl(IScreen):
         for window in reversed(self._layouts):
             window.draw(context)
 
+    def _reflow(self, row, col):
+        """
+        Rewraps the main buffer to col columns.  Blank lines below the cursor
+        go first when the screen shrinks, then lines scroll out of the top
+        (into the scrollback if any).
+
+        >>> from scrollback import Scrollback
+        >>> screen = Screen(3, 6, termprop=DummyTermprop(), scrollback=Scrollback())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('abcdefgh\\r\\nxy')
+        >>> screen.get_lines(), screen.getyx()
+        ([u'abcdef', u'gh', u'xy'], (2, 2))
+        >>> screen.resize(3, 3)
+        >>> screen.get_lines(), screen.getyx(), screen.scrollback.gettext(0)
+        ([u'def', u'gh', u'xy'], (2, 2), u'abc')
+        >>> screen.resize(3, 10)
+        >>> screen.get_lines(), screen.getyx()
+        ([u'defgh', u'xy', u''], (1, 2))
+        """
+        cursor = self.cursor
+        lines, y, x = reflow(self.lines[:], col, cursor.row, cursor.col)
+        while len(lines) > row and len(lines) - 1 > y and lines[-1].is_blank():
+            self._release_line(lines.pop())
+        excess = len(lines) - row
+        if excess > 0:
+            if self.scrollback is not None:
+                for line in lines[:excess]:
+                    self.scrollback.push(line)
+            del lines[:excess]
+            y -= excess
+        while len(lines) < row:
+            lines.append(self._new_line(col))
+        self.lines = self._mainbuf = LineRing(lines)
+        cursor.row = max(0, y)
+        cursor.col = x
+
     def resize(self, row, col):
         lines = self.lines
         height = len(lines)
         assert self.height == len(lines)
-        if row < height:
+        if col != self.width:
+            self._reset_line_pool()
+        if lines is self._mainbuf:
+            self._reflow(row, col)
+        elif row < height:
             while row != len(lines):
-                lines.pop()
+                self._release_line(lines.pop())
             for line in lines:
                 line.resize(col)
         elif row != height:
             for line in lines:
                 line.resize(col)
             while row > len(lines):
-                lines.insert(0, Line(col))
+                lines.insert(0, self._new_line(col))
         else:
             for line in lines:
                 line.resize(col)
-        assert row == len(lines)
-        for line in lines:
+        assert row == len(self.lines)
+        for line in self.lines:
             assert col == line.length()
+        del self._scrollops[:]
+        self._shadow = None
         if self.scroll_top == 0 and self.scroll_bottom == self.height:
             self.scroll_top = 0
             self.scroll_bottom = row
@@ -1331,6 +1766,49 @@ class IScreenImpl(IScreen):
                         cursor.col += 1
                 line.combine(c, col)
 
+    def write_run(self, run):
+        """
+        Writes a run of printable narrow characters at once.
+        Wrapping and DECAWM are handled once per line segment.
+
+        >>> from screen import MockScreenWithCursor
+        >>> screen = MockScreenWithCursor(3, 5)
+        >>> screen.write_run([ord(c) for c in 'abcdefg'])
+        >>> print screen.lines[0]
+        <ESC>[0mabcde
+        >>> print screen.lines[1]
+        <ESC>[0mfg<SP><SP><SP>
+        >>> screen.getyx()
+        (1, 2)
+        >>> screen.decawm = False
+        >>> screen.write_run([ord(c) for c in 'hijkl'])
+        >>> print screen.lines[1]
+        <ESC>[0mfghil
+        >>> screen.getyx()
+        (1, 5)
+        """
+        cursor = self.cursor
+        width = self.width
+        attrvalue = cursor.attr._attrvalue
+        start = 0
+        end = len(run)
+        while start < end:
+            col = cursor.col
+            if col >= width:
+                if self.decawm:
+                    self._wrap()
+                    col = cursor.col
+                else:
+                    # every remaining character lands on the last column
+                    start = max(start, end - 1)
+                    col = width - 1
+            n = min(width - col, end - start)
+            line = self.lines[cursor.row]
+            line.write_run(run, start, start + n, col, attrvalue)
+            start += n
+            cursor.col = col + n
+        cursor.dirty = True
+
     def setlistener(self, listener):
         self._listener = listener
 
@@ -1359,6 +1837,8 @@ class MockScreenWithWindows(MockScreen):
     def __init__(self, row=24, col=80, y=0, x=0):
         self.height = row
         self.width = col
+        self.scroll_top = 0
+        self.scroll_bottom = row
         self.cursor = Cursor(y, x)
         self._setup_lines()
 
@@ -1477,24 +1957,90 @@ class Window():
 
 
 class Ranges():
+    """
+    A set of columns, kept as a sorted list of disjoint half-open spans.
+
+    >>> ranges = Ranges()
+    >>> ranges.add(2, 5)
+    [(2, 5)]
+    >>> ranges.add(8, 10)
+    [(8, 10)]
+    >>> ranges.add(0, 12)
+    [(0, 2), (5, 8), (10, 12)]
+    >>> ranges.sub(3, 6)
+    >>> ranges.spans()
+    [(0, 3), (6, 12)]
+    >>> ranges.add(1, 7)
+    [(3, 6)]
+    >>> ranges.spans()
+    [(0, 12)]
+    """
 
     def __init__(self):
-        self._ranges = set()
+        self._ranges = []
+
+    def spans(self):
+        return self._ranges
 
     def add(self, start, end):
-        ranges = self._ranges
-        newrange = set(xrange(start, end))
-        dirtyrange = newrange.difference(ranges)
-        ranges.update(newrange)
-        return dirtyrange
+        """ adds [start, end) and returns the spans which were not in the set """
+        if start >= end:
+            return []
+        before = []
+        after = []
+        result = []
+        left = start
+        right = end
+        pos = start
+        for s, e in self._ranges:
+            if e < start:
+                before.append((s, e))
+            elif s > end:
+                after.append((s, e))
+            else:
+                if s > pos:
+                    result.append((pos, s))
+                if e > pos:
+                    pos = e
+                if s < left:
+                    left = s
+                if e > right:
+                    right = e
+        if pos < end:
+            result.append((pos, end))
+        before.append((left, right))
+        self._ranges = before + after
+        return result
 
     def sub(self, start, end):
-        ranges = self._ranges
-        newrange = set(xrange(start, end))
-        ranges.difference_update(newrange)
+        if start >= end:
+            return
+        result = []
+        for s, e in self._ranges:
+            if e <= start or s >= end:
+                result.append((s, e))
+            else:
+                if s < start:
+                    result.append((s, start))
+                if e > end:
+                    result.append((end, e))
+        self._ranges = result
 
 
 class Region():
+    """
+    Tracks the covered area of the screen, row by row.
+    add() returns a dict which maps each row to its newly covered spans.
+
+    >>> region = Region()
+    >>> region.add(2, 0, 4, 2)
+    {0: [(2, 6)], 1: [(2, 6)]}
+    >>> region.add(0, 1, 10, 1)
+    {1: [(0, 2), (6, 10)]}
+    >>> region.sub(3, 1, 2, 1)
+    >>> region.add(0, 1, 10, 1)
+    {1: [(3, 5)]}
+    """
 
     def __init__(self):
         self._lines = {}
@@ -1516,8 +2062,7 @@ class Region():
         lines = self._lines
         for index in xrange(top, top + height):
             if index in lines:
-                line = lines[index]
-                dirtyrange = line.sub(left, left + width)
+                lines[index].sub(left, left + width)
 
     def reset(self):
         self._lines = {}
@@ -1525,6 +2070,153 @@ class Region():
 class DummyTermprop():
     wcwidth = None
 
+class SupportsExtractionTrait():
+    ''' Reads text out of self.lines a line at a time, for Screen and
+        FrozenScreen. '''
+
+    def get_lines(self, start=0, end=None, strip=True):
+        '''
+        >>> screen = Screen(3, 6, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('ab\\r\\n\\x1b[31mcd\\x1b[m e')
+        >>> screen.get_lines()
+        [u'ab', u'cd e', u'']
+        >>> screen.get_lines(1, 2, strip=False)
+        [u'cd e  ']
+        '''
+        lines = self.lines
+        if end is None or end > self.height:
+            end = self.height
+        result = [lines[row].gettext() for row in xrange(max(0, start), end)]
+        if strip:
+            result = [text.rstrip(u' ') for text in result]
+        return result
+
+    def get_text(self, rect=None, strip=True):
+        '''
+        rect is (left, top, width, height), the whole screen if omitted.
+
+        >>> screen = Screen(3, 6, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('abcdef\\r\\nghijkl')
+        >>> screen.get_text((1, 0, 3, 2))
+        u'bcd\\nhij'
+        >>> screen.get_text()
+        u'abcdef\\nghijkl\\n'
+        '''
+        if rect is None:
+            left, top, width, height = 0, 0, self.width, self.height
+        else:
+            left, top, width, height = rect
+        lines = self.lines
+        right = left + width
+        bottom = min(top + height, self.height)
+        result = [lines[row].gettext(left, right)
+                  for row in xrange(max(0, top), bottom)]
+        if strip:
+            result = [text.rstrip(u' ') for text in result]
+        return u'\n'.join(result)
+
+    def iterruns(self, start=0, end=None):
+        '''
+        Yields (row, col, text, attrvalue) for each run of cells sharing
+        an attribute word.
+
+        >>> screen = Screen(2, 6, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('ab\\x1b[7mcd\\x1b[m')
+        >>> [(row, col, text) for row, col, text, value in screen.iterruns()]
+        [(0, 0, u'ab'), (0, 2, u'cd'), (0, 4, u'  '), (1, 0, u'      ')]
+        '''
+        lines = self.lines
+        if end is None or end > self.height:
+            end = self.height
+        for row in xrange(max(0, start), end):
+            for col, text, value in lines[row].getruns():
+                yield row, col, text, value
+
+
+class FrozenScreen(SupportsExtractionTrait):
+    ''' An immutable view of the lines of a Screen, made by Screen.freeze. '''
+
+    def __init__(self, lines, height, width, row, col, title):
+        self.lines = lines
+        self.height = height
+        self.width = width
+        self.cursor_row = row
+        self.cursor_col = col
+        self.title = title
+        # a reclaim renumbers the words of the screen in a new table, and
+        # leaves this one, which the words of these lines index, alone
+        self._table = _current_table()
+        self._sgr_cache = {}
+
+    def split_attr(self, value):
+        ''' returns (base, extras) of an attribute word of this view '''
+        return _split(value, self._table)
+
+    def get_sgr(self, current, value):
+        '''
+        attribute.get_sgr for the attribute words of this view.
+
+        >>> import attribute
+        >>> screen = Screen(1, 4, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('\\x1b[38;2;1;2;3mab\\x1b[m')
+        >>> frozen = screen.freeze()
+        >>> parser.parse('\\r\\x1b[38;2;4;5;6mab\\x1b[m')
+        >>> attribute._reclaim()
+        >>> def sgr(view):
+        ...     return [view.get_sgr(None, value).replace('\\x1b', '<ESC>')
+        ...             for row, col, text, value in view.iterruns()]
+        >>> sgr(frozen)
+        [u'<ESC>[0;38;2;1;2;3m', u'<ESC>[0m']
+        >>> [attribute.get_sgr(None, value).replace('\\x1b', '<ESC>')
+        ...  for row, col, text, value in screen.iterruns()]
+        [u'<ESC>[0;38;2;4;5;6m', u'<ESC>[0m']
+
+        A reader thread sees the same while the screen is fed and reclaimed.
+
+        >>> import threading
+        >>> frozen, errors, done = [screen.freeze()], [], threading.Event()
+        >>> frozen[0].title = u'<ESC>[0;38;2;4;5;6m'
+        >>> def read():
+        ...     while not done.is_set():
+        ...         view = frozen[0]
+        ...         try:
+        ...             first = sgr(view)[0]
+        ...             if first != view.title:
+        ...                 errors.append((first, view.title))
+        ...         except Exception, e:
+        ...             errors.append(e)
+        >>> reader = threading.Thread(target=read)
+        >>> reader.start()
+        >>> for i in xrange(256):
+        ...     parser.parse('\\r\\x1b[38;2;%d;0;0mab\\x1b[m' % i)
+        ...     view = screen.freeze()
+        ...     view.title = u'<ESC>[0;38;2;%d;0;0m' % i
+        ...     frozen[0] = view
+        ...     attribute._reclaim()
+        >>> done.set()
+        >>> reader.join()
+        >>> errors
+        []
+        '''
+        key = (current, value)
+        try:
+            return self._sgr_cache[key]
+        except KeyError:
+            sequence = _encode_sgr(current, value, self._table)
+            self._sgr_cache[key] = sequence
+            return sequence
+
+    def getyx(self):
+        return self.cursor_row, self.cursor_col
+
+    def gettitle(self):
+        return self.title
+
+
 class Screen(IScreenImpl,
              IFocusListenerImpl,
              IMouseListenerImpl,
@@ -1534,12 +2226,16 @@ class Screen(IScreenImpl,
              SupportsDoubleSizedTrait,
              SuuportsCursorPersistentTrait,
              SuuportsAlternateScreenTrait,
-             SuuportsISO2022DesignationTrait):
+             SupportsLinePoolTrait,
+             SuuportsISO2022DesignationTrait,
+             SupportsSnapshotTrait,
+             SupportsExtractionTrait):
 
     parent = None
+    scrollback = None
 
     def __init__(self, row=24, col=80, y=0, x=0,
-                 termenc="UTF-8", termprop=None):
+                 termenc="UTF-8", termprop=None, scrollback=None):
 
         """
         >>> screen = Screen(termprop=DummyTermprop())
@@ -1565,8 +2261,9 @@ class Screen(IScreenImpl,
             from termprop import Termprop
             termprop = Termprop()
 
-        self._wcwidth = termprop.wcwidth
+        self._wcwidth = get_wcwidth(termprop.wcwidth)
         self._termprop = termprop
+        self.scrollback = scrollback
 
         self._setup_lines()
         self._setup_altbuf()
@@ -1578,6 +2275,31 @@ class Screen(IScreenImpl,
         self._trash = []
 
         self._region = Region()
+        _register_owner(self)
+
+    def freeze(self):
+        '''
+        Returns a FrozenScreen of the current lines in O(rows). Cells are
+        not copied here; a line copies its cells when it is next modified.
+        Call it from the thread feeding the screen (or under output.lock);
+        the result can be read from any thread without locking.
+
+        >>> screen = Screen(2, 5, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('abc')
+        >>> frozen = screen.freeze()
+        >>> parser.parse('\\rxyz\\r\\nde')
+        >>> frozen.get_lines()
+        [u'abc', u'']
+        >>> screen.get_lines()
+        [u'xyz', u'de']
+        >>> frozen.getyx()
+        (0, 3)
+        '''
+        cursor = self.cursor
+        lines = tuple([line.freeze() for line in self.lines])
+        return FrozenScreen(lines, self.height, self.width,
+                            cursor.row, cursor.col, self._title)
 
     def create_child(self, row=24, col=80, y=0, x=0, termenc="UTF-8", termprop=None):
         child = Screen(row, col, y, x, termenc, termprop)
@@ -1586,7 +2308,8 @@ class Screen(IScreenImpl,
 
     def _setup_lines(self):
         width = self.width
-        self.lines = [ Line(width) for line in xrange(0, self.height) ]
+        self.lines = LineRing([ Line(width) for line in xrange(0, self.height) ])
+        self._scrollops = []
 
     def clear_screen(self):
         defaultvalue = self.cursor.attr.getdefaultvalue()
@@ -1644,7 +2367,9 @@ class Screen(IScreenImpl,
         self._trash.append(window)
 
     def _wrap(self):
-        self.cursor.col = 0
+        cursor = self.cursor
+        self.lines[cursor.row]._wrapped = True
+        cursor.col = 0
         self.lf()
 
     def settitle(self, s):
@@ -1665,6 +2390,14 @@ class Screen(IScreenImpl,
         self.cursor.dirty = True
 
     def lf(self):
+        """
+        >>> from scrollback import Scrollback
+        >>> screen = Screen(2, 3, termprop=DummyTermprop(), scrollback=Scrollback())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('a\\r\\nb\\r\\nc\\r\\nd')
+        >>> [screen.scrollback.gettext(i) for i in xrange(0, len(screen.scrollback))]
+        [u'a  ', u'b  ']
+        """
         cursor = self.cursor
         if cursor.col < self.width:
             #if self.cursor.col >= self.width:
@@ -1672,13 +2405,17 @@ class Screen(IScreenImpl,
             #        self._wrap()
             cursor.row += 1
             if cursor.row >= self.scroll_bottom:
-                bcevalue = cursor.attr.getbcevalue()
-                for line in self.lines[self.scroll_top + 1:self.scroll_bottom]:
-                    line.dirty = True
-                line = self.lines.pop(self.scroll_top)
-                line.clear(bcevalue)
-                self.lines.insert(self.scroll_bottom - 1, line)
-                cursor.row = self.scroll_bottom - 1
+                top = self.scroll_top
+                bottom = self.scroll_bottom
+                lines = self.lines
+                if top == 0 and self.scrollback is not None:
+                    if lines is self._mainbuf:
+                        self.scrollback.push(lines[0])
+                lines.rotate(top, bottom, 1)
+                line = lines[bottom - 1]
+                line.clear(cursor.attr.getbcevalue())
+                self._record_scroll(top, bottom, 1)
+                cursor.row = bottom - 1
             cursor.dirty = True
 
     def ind(self):
@@ -1691,13 +2428,14 @@ class Screen(IScreenImpl,
     def ri(self):
         cursor = self.cursor
         if cursor.row <= self.scroll_top:
-            bcevalue = cursor.attr.getbcevalue()
-            for line in self.lines:
-                line.dirty = True
-            line = self.lines.pop(self.scroll_bottom - 1)
-            line.clear(bcevalue)
-            self.lines.insert(self.scroll_top, line)
-            cursor.row = self.scroll_top
+            top = self.scroll_top
+            bottom = self.scroll_bottom
+            lines = self.lines
+            lines.rotate(top, bottom, -1)
+            line = lines[top]
+            line.clear(cursor.attr.getbcevalue())
+            self._record_scroll(top, bottom, -1)
+            cursor.row = top
         else:
             cursor.row -= 1
         cursor.dirty = True
@@ -1728,16 +2466,13 @@ class Screen(IScreenImpl,
             self.cursor.row = self.scroll_top
         if col >= self.width:
             self.cursor.col = self.width - 1
-        cells = self.lines[row].cells
+        line = self.lines[row]
 
-        if col > 0 and cells[col - 1].get() == '\x00':
+        if col > 0 and line.get(col - 1) is None:
             col -= 1
 
         bcevalue = cursor.attr.getbcevalue()
-        for i in xrange(0, n):
-            cell = cells.pop(col)
-            cell.clear(bcevalue)
-            cells.append(cell)
+        line.delete(col, n, bcevalue)
 
         self.cursor.dirty = True
 
@@ -1796,20 +2531,16 @@ class Screen(IScreenImpl,
             cursor.col = self.width - 1
         if ps == 0:
             line = self.lines[cursor.row]
-            line.dirty = True
             attr = cursor.attr
             bcevalue = attr.getbcevalue()
-            for cell in line.cells[cursor.col:]:
-                cell.clear(bcevalue)
+            line.erase(cursor.col, self.width, bcevalue)
             if cursor.row < self.height:
                 for line in self.lines[cursor.row + 1:]:
                     line.clear(bcevalue)
         elif ps == 1:
             line = self.lines[cursor.row]
-            line.dirty = True
             bcevalue = cursor.attr.getbcevalue()
-            for cell in line.cells[:cursor.col]:
-                cell.clear(bcevalue)
+            line.erase(0, cursor.col, bcevalue)
             if cursor.row > 0:
                 for line in self.lines[:cursor.row]:
                     line.clear(bcevalue)
@@ -1819,11 +2550,9 @@ class Screen(IScreenImpl,
                 line.clear(bcevalue)
 
     def decaln(self):
-        attr = self.cursor.attr
+        attrvalue = self.cursor.attr._attrvalue
         for line in self.lines:
-            line.dirty = True
-            for cell in line.cells:
-                cell.write(0x45, attr)  # E
+            line.fill(0x45, attrvalue)  # E
         self.scroll_top = 0
         self.scroll_bottom = self.height
 
@@ -1832,6 +2561,7 @@ class Screen(IScreenImpl,
         defaultvalue = cursor.attr.getdefaultvalue()
         for line in self.lines:
             line.clear(defaultvalue)
+        self._shadow = None
         self.reset_modes()
         cursor.clear()
         self._setup_tab()
@@ -1864,16 +2594,13 @@ class Screen(IScreenImpl,
             self.cursor.row = self.scroll_top
         if col >= self.width:
             self.cursor.col = self.width - 1
-        cells = self.lines[row].cells
+        line = self.lines[row]
 
-        if col > 0 and cells[col - 1].get() == '\x00':
+        if col > 0 and line.get(col - 1) is None:
             col -= 1
 
         bcevalue = cursor.attr.getbcevalue()
-        for i in xrange(0, ps):
-            cell = cells.pop()
-            cell.clear(bcevalue)
-            cells.insert(col, cell)
+        line.insert(col, ps, bcevalue)
 
     def cuu(self, ps):
         ''' cursor up '''
@@ -1909,11 +2636,14 @@ class Screen(IScreenImpl,
         row = self.cursor.row
         lines = self.lines
         bottom = self.scroll_bottom
-        for line in lines[row + ps:bottom]:
-            line.dirty = True
-        for x in xrange(0, ps):
-            lines.insert(bottom, Line(self.width))
-            lines.pop(row)
+        if row < self.scroll_top or row >= bottom:
+            return
+        ps = min(ps, bottom - row)
+        lines.rotate(row, bottom, ps)
+        defaultvalue = Attribute.defaultvalue
+        for i in xrange(bottom - ps, bottom):
+            lines[i].clear(defaultvalue)
+        self._record_scroll(row, bottom, ps)
 
     def il(self, ps):
         cursor = self.cursor
@@ -1924,11 +2654,36 @@ class Screen(IScreenImpl,
         row = self.cursor.row
         lines = self.lines
         bottom = self.scroll_bottom
-        for line in lines[row:bottom - ps]:
-            line.dirty = True
-        for x in xrange(0, ps):
-            lines.pop(bottom - 1)
-            lines.insert(row, Line(self.width))
+        if row < self.scroll_top or row >= bottom:
+            return
+        ps = min(ps, bottom - row)
+        lines.rotate(row, bottom, -ps)
+        defaultvalue = Attribute.defaultvalue
+        for i in xrange(row, row + ps):
+            lines[i].clear(defaultvalue)
+        self._record_scroll(row, bottom, -ps)
+
+    def ech(self, n):
+        '''
+        erase n character(s) from the cursor, which does not move
+
+        >>> screen = Screen(2, 6, termprop=DummyTermprop())
+        >>> parser = _generate_mock_parser(screen)
+        >>> parser.parse('abcdef\\x1b[1;3H\\x1b[2X')
+        >>> screen.get_lines(), screen.getyx()
+        ([u'ab  ef', u''], (0, 2))
+        >>> parser.parse('\\x1b[9X')
+        >>> screen.get_lines()
+        [u'ab', u'']
+        '''
+        cursor = self.cursor
+        if cursor.row >= self.height:
+            cursor.row = self.height - 1
+        if cursor.col >= self.width:
+            cursor.col = self.width - 1
+        col = cursor.col
+        line = self.lines[cursor.row]
+        line.erase(col, min(col + n, self.width), cursor.attr.getbcevalue())
 
     def el(self, ps):
         cursor = self.cursor
@@ -1938,17 +2693,16 @@ class Screen(IScreenImpl,
             cursor.col = self.width - 1
         line = self.lines[cursor.row]
         if ps == 0:
-            cells = line.cells[cursor.col:]
+            left, right = cursor.col, self.width
         elif ps == 1:
-            cells = line.cells[:cursor.col]
+            left, right = 0, cursor.col
         elif ps == 2:
-            cells = line.cells
+            left, right = 0, self.width
         else:
             return
         line.dirty = True
         bcevalue = self.cursor.attr.getbcevalue()
-        for cell in cells:
-            cell.clear(bcevalue)
+        line.erase(left, right, bcevalue)
 
 
 class MockScreenWithCursor(Screen):
@@ -1962,6 +2716,8 @@ class MockScreenWithCursor(Screen):
         self.init_modemap()
         self.height = row
         self.width = col
+        self.scroll_top = 0
+        self.scroll_bottom = row
         self.cursor = Cursor(y, x)
         self._setup_lines()
         self._setup_altbuf()
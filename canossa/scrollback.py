@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+from line import decode_line, _encoded_attrs, _remap_encoded
+
+
+class Scrollback():
+    '''
+    Keeps the lines scrolled off the top of the screen, in the compact
+    form made by Line.encode. The oldest lines are discarded when the
+    number of lines exceeds maxlines or the total size exceeds maxbytes.
+
+    >>> from line import Line
+    >>> from attribute import Attribute
+    >>> scrollback = Scrollback(maxlines=3)
+    >>> for c in u'abcde':
+    ...     line = Line(4)
+    ...     line.write(ord(c), 0, Attribute())
+    ...     scrollback.push(line)
+    >>> len(scrollback), scrollback.discarded()
+    (3, 2)
+    >>> scrollback.gettext(0)
+    u'c   '
+    >>> scrollback[-1].get(0)
+    u'e'
+    >>> [scrollback.gettext(i)[0] for i in xrange(0, len(scrollback))]
+    [u'c', u'd', u'e']
+    >>> scrollback[3]
+    Traceback (most recent call last):
+    ...
+    IndexError: scrollback index out of range
+    >>> scrollback = Scrollback(maxbytes=300)
+    >>> for i in xrange(0, 10):
+    ...     scrollback.push(Line(80))
+    >>> len(scrollback), scrollback.size()
+    (3, 279)
+    '''
+
+    def __init__(self, maxlines=None, maxbytes=None):
+        self.maxlines = maxlines
+        self.maxbytes = maxbytes
+        self._records = []
+        self._start = 0
+        self._bytes = 0
+        self._discarded = 0
+
+    def __len__(self):
+        return len(self._records) - self._start
+
+    def __getitem__(self, index):
+        return decode_line(self.getdata(index))
+
+    def discarded(self):
+        ''' returns the number of lines dropped so far, which is the serial
+            number of the line at index 0 '''
+        return self._discarded
+
+    def size(self):
+        ''' returns the total bytes of the encoded lines '''
+        return self._bytes
+
+    def getdata(self, index):
+        ''' returns the encoded line at specified index (0 is the oldest) '''
+        length = len(self._records) - self._start
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("scrollback index out of range")
+        return self._records[self._start + index]
+
+    def gettext(self, index):
+        ''' returns the text of the line at specified index '''
+        return self[index].gettext()
+
+    def push(self, line):
+        data = line.encode()
+        self._records.append(data)
+        self._bytes += len(data)
+        self._trim()
+
+    def _collect_attrs(self, used):
+        for data in self._records[self._start:]:
+            used.update(_encoded_attrs(data))
+
+    def _remap_attrs(self, mapping):
+        records = self._records
+        for i in xrange(self._start, len(records)):
+            data = records[i]
+            for value in _encoded_attrs(data):
+                if value in mapping:
+                    records[i] = _remap_encoded(data, mapping)
+                    break
+
+    def clear(self):
+        self._discarded += len(self)
+        self._records = []
+        self._start = 0
+        self._bytes = 0
+
+    def _trim(self):
+        records = self._records
+        start = self._start
+        maxlines = self.maxlines
+        maxbytes = self.maxbytes
+        while start < len(records):
+            if maxlines is not None and len(records) - start > maxlines:
+                pass
+            elif maxbytes is not None and self._bytes > maxbytes:
+                pass
+            else:
+                break
+            self._bytes -= len(records[start])
+            records[start] = None
+            start += 1
+            self._discarded += 1
+        # drop the discarded slots in bulk, so that eviction stays O(1)
+        # amortized without shifting the list on each push
+        if start > 256 and start * 2 > len(records):
+            del records[:start]
+            start = 0
+        self._start = start
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+
+
+import re
+from bisect import bisect_left, bisect_right
+
+
+def _offset_to_col(line, offset):
+    '''
+    Maps an offset in line.gettext() to the column of its cell.  For a wide
+    character that is the padding cell on its left.
+
+    >>> from line import Line
+    >>> from attribute import Attribute
+    >>> line = Line(6)
+    >>> line.pad(0)
+    >>> line.write(0x3042, 1, Attribute())
+    >>> line.write(0x41, 2, Attribute())
+    >>> line.combine(0x300, 3)
+    >>> [_offset_to_col(line, i) for i in xrange(0, 5)]
+    [0, 2, 2, 3, 4]
+    '''
+    chars = line._chars
+    combine = line._combine
+    if not combine and 0 not in chars:
+        return offset
+    if combine is None:
+        combine = {}
+    n = 0
+    for pos in xrange(0, len(chars)):
+        if chars[pos] == 0:
+            continue
+        n += 1
+        if pos in combine:
+            n += len(combine[pos])
+        if n > offset:
+            if pos > 0 and chars[pos - 1] == 0:
+                return pos - 1
+            return pos
+    return len(chars)
+
+
+class SearchIndex():
+    ''' Keeps the text of a screen and its scrollback ready for searching.
+
+    A screen line is decoded again only after it has been modified.  The
+    index holds a frozen copy of each line, so the next write to the line
+    replaces its cell arrays (see Line.freeze), which is checked by
+    identity.  Scrollback lines never change and are decoded once.
+
+    Matches are returned as (row, col); rows of the scrollback are negative,
+    -1 being the latest line scrolled out.  Soft-wrapped lines are joined,
+    so a match can start on one row and end on the next.
+
+    >>> from termprop import MockTermprop
+    >>> from screen import Screen, _generate_mock_parser
+    >>> from scrollback import Scrollback
+    >>> screen = Screen(2, 5, termprop=MockTermprop(), scrollback=Scrollback())
+    >>> parser = _generate_mock_parser(screen)
+    >>> parser.parse('hello\\r\\nxxcanossa\\r\\nA\\xe3\\x81\\x82foo')
+    >>> index = SearchIndex(screen)
+    >>> screen.get_lines()
+    [u'A\\u3042fo', u'o']
+    >>> index.search('canossa')
+    [(-2, 2)]
+    >>> index.search('foo')
+    [(0, 3)]
+    >>> index.search('l+o', regex=True)
+    [(-3, 2)]
+    >>> index.search('HELLO', ignorecase=True)
+    [(-3, 0)]
+    >>> parser.parse('\\r\\nfoo')
+    >>> index.search('foo')
+    [(-1, 3), (1, 0)]
+    >>> for i in xrange(0, 400):
+    ...     parser.parse('\\r\\nline%d' % i)
+    >>> len(index.search('line39'))
+    11
+    >>> screen.scrollback.clear()
+    >>> index.search('line39')
+    [(0, 0)]
+    '''
+
+    def __init__(self, screen):
+        self._screen = screen
+        self._rows = {}       # Line -> (frozen line, text)
+        self._scrollback = None
+        self._hdoc = u''      # the text of the scrollback lines
+        self._hstarts = []    # where each scrollback line starts in _hdoc
+        self._hserial = 0     # serial number of the line at _hstarts[0]
+
+    def refresh(self):
+        cache = self._rows
+        rows = {}
+        for line in self._screen.lines:
+            entry = cache.get(line)
+            if entry is not None:
+                frozen = entry[0]
+                if (frozen._chars is not line._chars
+                    or frozen._wrapped != line._wrapped):
+                    entry = None
+            if entry is None:
+                frozen = line.freeze()
+                entry = (frozen, frozen.gettext())
+            rows[line] = entry
+        self._rows = rows
+        self._refresh_history()
+
+    def _refresh_history(self):
+        scrollback = self._screen.scrollback
+        if scrollback is None:
+            first = end = 0
+        else:
+            first = scrollback.discarded()
+            end = first + len(scrollback)
+        starts = self._hstarts
+        last = self._hserial + len(starts)
+        if scrollback is not self._scrollback or last < first or last > end:
+            self._scrollback = scrollback
+            self._hdoc = u''
+            self._hstarts = starts = []
+            self._hserial = last = first
+
+        if last < end:
+            parts = []
+            pos = len(self._hdoc)
+            for serial in xrange(last, end):
+                line = scrollback[serial - first]
+                text = line.gettext()
+                if not line._wrapped:
+                    text += u'\n'
+                starts.append(pos)
+                parts.append(text)
+                pos += len(text)
+            self._hdoc += u''.join(parts)
+
+        # drop the text of the discarded lines in bulk
+        n = first - self._hserial
+        if n and n >= len(starts):
+            self._hdoc = u''
+            self._hstarts = []
+            self._hserial = first
+        elif n > 256 and n * 2 > len(starts):
+            cut = starts[n]
+            self._hdoc = self._hdoc[cut:]
+            self._hstarts = [x - cut for x in starts[n:]]
+            self._hserial = first
+
+    def search(self, pattern, regex=False, ignorecase=False):
+        ''' returns the (row, col) of each match, oldest first '''
+        self.refresh()
+        flags = re.UNICODE
+        if ignorecase:
+            flags |= re.IGNORECASE
+        if not regex:
+            pattern = re.escape(pattern)
+        compiled = re.compile(pattern, flags)
+
+        screen = self._screen
+        scrollback = self._scrollback
+        rows = self._rows
+        lines = screen.lines[:]
+        hdoc = self._hdoc
+        hstarts = self._hstarts
+        nhistory = 0
+        if scrollback is not None:
+            nhistory = len(scrollback)
+        skip = len(hstarts) - nhistory
+        if skip < len(hstarts):
+            begin = hstarts[skip]
+        else:
+            begin = len(hdoc)
+
+        # the last logical line of the history may continue on the screen,
+        # so it is searched along with the screen text
+        tail = max(begin, hdoc.rfind(u'\n') + 1)
+        first = bisect_left(hstarts, tail)
+        ntail = len(hstarts) - first
+        starts = [x - tail for x in hstarts[first:]]
+        parts = [hdoc[tail:]]
+        pos = len(parts[0])
+        for line in lines:
+            text = rows[line][1]
+            if not line._wrapped:
+                text += u'\n'
+            starts.append(pos)
+            parts.append(text)
+            pos += len(text)
+        doc = u''.join(parts)
+
+        result = []
+        for match in compiled.finditer(hdoc, begin, tail):
+            start = match.start()
+            if start == match.end() or u'\n' in match.group():
+                continue
+            i = bisect_right(hstarts, start) - 1
+            line = scrollback[i - skip]
+            result.append((i - skip - nhistory,
+                           _offset_to_col(line, start - hstarts[i])))
+        for match in compiled.finditer(doc):
+            start = match.start()
+            if start == match.end() or u'\n' in match.group():
+                continue
+            i = bisect_right(starts, start) - 1
+            offset = start - starts[i]
+            if i < ntail:
+                i += first
+                row = i - skip - nhistory
+                line = scrollback[i - skip]
+            else:
+                row = i - ntail
+                line = rows[lines[row]][0]
+            result.append((row, _offset_to_col(line, offset)))
+        return result
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+from array import array
+from attribute import Attribute, get_sgr
+from line import _CHAR_PAD, _CHAR_BLANK, _LINE_TYPE_SWL, _unichr
+
+# changed cells closer than this are redrawn together rather than
+# skipping the unchanged ones with a cursor motion
+_MERGE_GAP = 3
+
+
+def _csi(n, final):
+    if n == 1:
+        return '\x1b[' + final
+    return '\x1b[%d%s' % (n, final)
+
+
+def _motion(fromrow, fromcol, row, col):
+    """
+    Returns the shortest sequence which moves the cursor from
+    (fromrow, fromcol) to (row, col). Unknown positions are None.
+
+    >>> _motion(None, None, 2, 5)
+    '\\x1b[3;6H'
+    >>> _motion(2, 4, 2, 5)
+    '\\x1b[C'
+    >>> _motion(2, 8, 2, 0)
+    '\\r'
+    >>> _motion(2, 5, 3, 5)
+    '\\x1b[B'
+    >>> _motion(2, None, 2, 30)
+    '\\x1b[31G'
+    >>> _motion(2, 5, 2, 5)
+    ''
+    """
+    if col == 0:
+        cup = '\x1b[%dH' % (row + 1)
+    else:
+        cup = '\x1b[%d;%dH' % (row + 1, col + 1)
+    if fromrow is None:
+        return cup
+
+    if fromcol == col:
+        horizontal = ''
+    elif col == 0:
+        horizontal = '\r'
+    else:
+        horizontal = _csi(col + 1, 'G')
+        if fromcol is not None:
+            if col > fromcol:
+                relative = _csi(col - fromcol, 'C')
+            else:
+                relative = _csi(fromcol - col, 'D')
+            if len(relative) < len(horizontal):
+                horizontal = relative
+
+    if fromrow == row:
+        vertical = ''
+    elif row > fromrow:
+        vertical = _csi(row - fromrow, 'B')
+    else:
+        vertical = _csi(fromrow - row, 'A')
+
+    if len(vertical) + len(horizontal) < len(cup):
+        return vertical + horizontal
+    return cup
+
+
+class Shadow():
+    """
+    Keeps a copy of what has been emitted to the terminal, so that the
+    next frame only has to emit the cells which have changed since.
+
+    >>> import StringIO
+    >>> from line import Line
+    >>> lines = [Line(8) for i in xrange(0, 2)]
+    >>> shadow = Shadow(2, 8)
+    >>> s = StringIO.StringIO()
+    >>> shadow.draw(s, lines, Attribute())
+    >>> print s.getvalue().replace('\\x1b', '<ESC>').replace(' ', '<SP>')
+    <ESC>[1H<ESC>#5<SP><SP><SP><SP><SP><SP><SP><SP><ESC>[2H<ESC>#5<SP><SP><SP><SP><SP><SP><SP><SP>
+    >>> attr = Attribute()
+    >>> lines[1].write(0x41, 2, attr)
+    >>> lines[1].write(0x42, 6, attr)
+    >>> s.truncate(0)
+    >>> shadow.draw(s, lines, Attribute())
+    >>> print s.getvalue().replace('\\x1b', '<ESC>').replace(' ', '<SP>')
+    <ESC>[2;3HA<SP><SP><SP>B
+    >>> lines[0].write(0x43, 7, attr)
+    >>> lines[1].write(0x43, 0, attr)
+    >>> s.truncate(0)
+    >>> shadow.draw(s, lines, Attribute())
+    >>> print s.getvalue().replace('\\x1b', '<ESC>').replace(' ', '<SP>')
+    <ESC>[1;8HC<ESC>[2HC
+    """
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+        self._rows = [None] * height
+        self._row = None
+        self._col = None
+
+    def _blank(self):
+        width = self.width
+        return (_LINE_TYPE_SWL,
+                array('i', [_CHAR_BLANK]) * width,
+                array('l', [Attribute.defaultvalue]) * width,
+                None)
+
+    def scroll(self, top, bottom, n):
+        """
+        Follows a hardware scroll of the region [top, bottom), which has been
+        emitted with the default attribute and has left the cursor at home.
+        """
+        rows = self._rows
+        region = rows[top:bottom]
+        if n > 0:
+            region = region[n:] + [self._blank() for i in xrange(0, n)]
+        else:
+            region = [self._blank() for i in xrange(0, -n)] + region[:n]
+        rows[top:bottom] = region
+        self._row = 0
+        self._col = 0
+
+    def _diff(self, chars, attrs, combine, shadow):
+        linetype, schars, sattrs, scombine = shadow
+        if chars == schars and attrs == sattrs and combine == scombine:
+            return []
+        width = self.width
+        changed = [pos for pos in xrange(0, width)
+                   if chars[pos] != schars[pos] or attrs[pos] != sattrs[pos]]
+        if combine != scombine:
+            combine = combine or {}
+            scombine = scombine or {}
+            for pos in set(combine.keys() + scombine.keys()):
+                if combine.get(pos) != scombine.get(pos):
+                    changed.append(pos)
+            changed.sort()
+        spans = []
+        for pos in changed:
+            start = pos
+            end = pos + 1
+            # never split a wide character, in the new or the old content
+            if start > 0 and (chars[start - 1] == _CHAR_PAD or schars[start - 1] == _CHAR_PAD):
+                start -= 1
+            if end < width and (chars[end - 1] == _CHAR_PAD or schars[end - 1] == _CHAR_PAD):
+                end += 1
+            if spans and start - spans[-1][1] <= _MERGE_GAP:
+                if end > spans[-1][1]:
+                    spans[-1] = (spans[-1][0], end)
+            else:
+                spans.append((start, end))
+        return spans
+
+    def draw(self, s, lines, attr):
+        """
+        Emits the difference between the lines and the shadow. attr is
+        the current attribute of the terminal, and it is kept up to date.
+        """
+        rows = self._rows
+        width = self.width
+        current = attr._attrvalue
+        row = self._row
+        col = self._col
+        for i in xrange(0, self.height):
+            line = lines[i]
+            shadow = rows[i]
+            if shadow is not None and not line.dirty:
+                continue
+            line.dirty = False
+            chars = line._chars
+            attrs = line._attrs
+            combine = line._combine or None
+            linetype = line._type
+            if shadow is None or linetype != _LINE_TYPE_SWL or shadow[0] != linetype:
+                s.write(_motion(row, col, i, 0))
+                s.write('\x1b#%d' % linetype)
+                row = i
+                col = 0
+                spans = [(0, width)]
+            else:
+                spans = self._diff(chars, attrs, combine, shadow)
+            for start, end in spans:
+                s.write(_motion(row, col, i, start))
+                for pos in xrange(start, end):
+                    c = chars[pos]
+                    if c != _CHAR_PAD:
+                        value = attrs[pos]
+                        if value != current:
+                            s.write(get_sgr(current, value))
+                            current = value
+                        if combine and pos in combine:
+                            s.write(_unichr(c) + combine[pos])
+                        else:
+                            s.write(_unichr(c))
+                row = i
+                if end < width and linetype == _LINE_TYPE_SWL:
+                    col = end
+                else:
+                    col = None # pending wrap
+            if spans:
+                rows[i] = (linetype, array('i', chars), array('l', attrs),
+                           combine and dict(combine))
+        attr.setvalue(current)
+        self._row = None
+        self._col = None
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == "__main__":
+    test()
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# ***** BEGIN LICENSE BLOCK *****
+# Copyright (C) 2012-2014, Hayaki Saito
+#
+# Permission is hereby granted, free of charge, to any person obtaining a
+# copy of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT.  IN NO EVENT SHALL
+# THE AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING
+# FROM, OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER
+# DEALINGS IN THE SOFTWARE.
+# ***** END LICENSE BLOCK *****
+
+'''
+    A two-stage lookup table in front of termprop's wcwidth.
+
+    The first stage is indexed by the upper byte of a BMP code point and
+    points to a 256-entry bytearray block, which holds (width + 1) of each
+    code point in it. The blocks are built lazily on the first lookup and
+    identical blocks are shared, so the whole BMP costs a few kilobytes.
+    Code points outside the BMP fall through to the original function.
+
+    The tables are kept per wcwidth function, so that every screen using
+    the same termprop configuration shares one.
+'''
+
+_TABLES = {}
+
+
+def _build_block(wcwidth, base, blocks):
+    block = bytearray([wcwidth(c) + 1 for c in xrange(base, base + 0x100)])
+    key = str(block)
+    try:
+        return blocks[key]
+    except KeyError:
+        blocks[key] = block
+        return block
+
+
+def _make_wcwidth(wcwidth):
+    table = [None] * 0x100
+    blocks = {}
+
+    def table_wcwidth(c):
+        if c < 0x10000:
+            block = table[c >> 8]
+            if block is None:
+                block = table[c >> 8] = _build_block(wcwidth, c & ~0xff, blocks)
+            return block[c & 0xff] - 1
+        return wcwidth(c)
+
+    return table_wcwidth
+
+
+def _make_wcswidth(wcwidth):
+
+    def table_wcswidth(run):
+        n = 0
+        high = None
+        for s in run:
+            c = ord(s)
+            if 0xd800 <= c < 0xdc00:
+                high = c
+                continue
+            elif high is not None and 0xdc00 <= c < 0xe000:
+                c = (high - 0xd800 << 10 | c - 0xdc00) + 0x10000
+            high = None
+            width = wcwidth(c)
+            if width == -1:
+                return -1
+            n += width
+        return n
+
+    return table_wcswidth
+
+
+def get_wcwidth(wcwidth):
+    '''
+    returns a table-driven function equivalent to specified wcwidth.
+
+    >>> from termprop.wcwidth import wcwidth, wcwidth_cjk
+    >>> f = get_wcwidth(wcwidth)
+    >>> f is get_wcwidth(wcwidth)
+    True
+    >>> f is get_wcwidth(wcwidth_cjk)
+    False
+    >>> all(f(c) == wcwidth(c) for c in xrange(0, 0x10000))
+    True
+    >>> f(0x3042), f(0x20000), f(0x0a), f(0x300)
+    (2, 2, -1, 0)
+    >>> get_wcwidth(wcwidth_cjk)(0x25cb)
+    2
+    >>> get_wcwidth(None) is None
+    True
+    '''
+    if wcwidth is None:
+        return None
+    try:
+        return _TABLES[wcwidth][0]
+    except KeyError:
+        table_wcwidth = _make_wcwidth(wcwidth)
+        _TABLES[wcwidth] = (table_wcwidth, _make_wcswidth(table_wcwidth))
+        return table_wcwidth
+
+
+def get_wcswidth(wcwidth):
+    '''
+    returns a function which measures the width of a unicode string,
+    or -1 if it contains a control character.
+
+    >>> from termprop.wcwidth import wcwidth, wcswidth
+    >>> f = get_wcswidth(wcwidth)
+    >>> f(u'abc\\u3042'), f(u'a\\x1b'), f(u'\\U00020000')
+    (5, -1, 2)
+    '''
+    if wcwidth is None:
+        return None
+    get_wcwidth(wcwidth)
+    return _TABLES[wcwidth][1]
+
+
+def test():
+    import doctest
+    doctest.testmod()
+
+
+if __name__ == "__main__":
+    test()
@@ -23,14 +23,29 @@ import canossa.attribute as attribute
 import canossa.line as line
 import canossa.cursor as cursor
 import canossa.screen as screen
+import canossa.scrollback as scrollback
+import canossa.shadow as shadow
+import canossa.widthtable as widthtable
 import canossa.popup as popup
 import canossa.iframe as iframe
 import canossa.output as output
+import canossa.instrument as instrument
+import canossa.search as search
+import canossa.driver as driver
+
+modules = [attribute, cell, line, cursor,
+           attribute, popup, iframe, output, screen, scrollback,
+           shadow, widthtable, instrument, search, driver]
+try:
+    # needs multiprocessing, which python 2.5 does not have
+    import canossa.host as host
+    modules.append(host)
+except ImportError:
+    pass
 
 import doctest
 dirty = False
-for m in (attribute, cell, line, cursor,
-          attribute, popup, iframe, output, screen):
+for m in modules:
     failure_count, test_count = doctest.testmod(m)
     if failure_count > 0:
         dirty = True